@@ -0,0 +1,4 @@
+"""
+Benchmarks of Espial. The scripts in this directory measure a real knowledge base, the
+`scenarios` module a synthetic one (see `synthetic` and `pipeline`), with no model download.
+"""
@@ -0,0 +1,74 @@
+"""
+Compare the resident memory of a loaded mesh when every parsed doc is kept in memory and when
+docs are loaded lazily (`ANALYSIS["lazy_docs"]`).
+
+    python benchmarks/doc_memory.py <data-dir> --cache-size 128
+
+Each mode is loaded in its own process, after a first run has filled the annotation store.
+Prints a JSON list with the resident memory of each mode in MB.
+"""
+import json
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+
+
+def resident_mb():
+    """Current resident set size, or the peak one where /proc isn't available."""
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load(data_dir, cache_size):
+    from espial.cli import load_config
+    from espial.load import load_mesh
+
+    config = load_config(Path(data_dir))
+    config.ANALYSIS["lazy_docs"]["enabled"] = cache_size is not None
+    config.ANALYSIS["lazy_docs"]["cache_size"] = cache_size or 0
+    start = time.perf_counter()
+    mesh, nlp, rerun = load_mesh(config)
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": "lazy" if cache_size is not None else "eager",
+        "cache_size": cache_size,
+        "docs": len(mesh.doc_cache),
+        "load_seconds": round(elapsed, 3),
+        "rss_mb": round(resident_mb(), 1),
+    }
+
+
+@click.command()
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--cache-size", type=int, default=128, help="Parsed docs kept in lazy mode.")
+@click.option("--child", type=int, default=None, hidden=True)
+def main(data_dir, cache_size, child):
+    if child is not None:  # measure a single mode, -1 is eager
+        click.echo(json.dumps(load(data_dir, None if child < 0 else child)))
+        return
+    results = []
+    for mode in (-1, -1, cache_size):  # the first run parses and stores the docs
+        out = subprocess.run(
+            [sys.executable, __file__, data_dir, "--child", str(mode)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    results = results[1:]
+    for row in results:
+        click.echo(f"{row['mode']}: {row['rss_mb']} MB resident", err=True)
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measure how fast load_mesh's spaCy pipeline parses documents depending on the number of
+worker processes (`ANALYSIS["n_process"]`).
+
+    python benchmarks/ingest_scaling.py <data-dir> --workers 1 --workers 2 --workers 4
+
+Prints a JSON list with the docs/sec reached by each worker count.
+"""
+import json
+import time
+from pathlib import Path
+
+import click
+import spacy
+from espial.analysis import process_markdown
+
+
+@click.command()
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--workers", type=int, multiple=True, default=[1, 2, 4, 8], help="Worker counts to compare.")
+@click.option("--batch-size", type=int, default=40)
+@click.option("--limit", type=int, default=2000, help="Maximum number of documents parsed.")
+@click.option("--model", default="en_core_web_md")
+def main(data_dir, workers, batch_size, limit, model):
+    paths = sorted(Path(data_dir).rglob("*.md"))[:limit]
+    texts = [process_markdown(path.open("r").read()) for path in paths]
+    nlp = spacy.load(model)
+    results = []
+    for n_process in workers:
+        start = time.perf_counter()
+        for doc in nlp.pipe(
+            texts, disable=["textcat"], batch_size=batch_size, n_process=n_process
+        ):
+            pass
+        elapsed = time.perf_counter() - start
+        results.append(
+            {
+                "workers": n_process,
+                "docs": len(texts),
+                "seconds": round(elapsed, 3),
+                "docs_per_sec": round(len(texts) / elapsed, 1),
+            }
+        )
+        click.echo(f"{n_process} workers: {results[-1]['docs_per_sec']} docs/sec", err=True)
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+A small spaCy pipeline for the synthetic vaults, that runs without downloading a model.
+
+Its only component tags every word as a noun that heads its own noun chunk, lemmatizes plurals,
+and marks runs of capitalized words as ORG entities. Word vectors are deterministic: the words
+of a topic share a component, so notes about the same topic are similar, like with real vectors.
+"""
+from hashlib import md5
+from pathlib import Path
+
+import numpy as np
+import spacy
+from spacy.language import Language
+from spacy.tokens import Span
+
+
+@Language.component("espial_bench_parser")
+def bench_parser(doc):
+    ents = []
+    start = None
+    for token in doc:
+        token.lemma_ = token.lower_[:-1] if token.lower_.endswith("s") and len(token) > 4 else token.lower_
+        if token.is_alpha and not token.is_stop:
+            token.pos_ = "PROPN" if token.text[0].isupper() else "NOUN"
+            token.dep_ = "ROOT"
+        else:
+            token.pos_ = "X"
+            token.dep_ = "dep"
+        token.head = token
+        if token.is_alpha and token.text[0].isupper():
+            if start is None:
+                start = token.i
+        elif start is not None:
+            ents.append(Span(doc, start, token.i, label="ORG"))
+            start = None
+    if start is not None:
+        ents.append(Span(doc, start, len(doc), label="ORG"))
+    doc.ents = ents
+    return doc
+
+
+def random_vector(key, dim):
+    seed = int(md5(key.encode()).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def word_vectors(vocab, dim=64):
+    """word -> vector, for the words of a vocabulary (see synthetic.vocabulary)."""
+    vectors = {}
+    for t, topic in enumerate(vocab["topics"]):
+        for word in topic:
+            vectors[word] = random_vector(f"topic {t}", dim) * 1.5 + random_vector(word, dim)
+    for name in vocab["entities"]:
+        for word in name.split():
+            vectors[word.lower()] = random_vector(word.lower(), dim)
+    for word in vocab["common"]:
+        vectors[word] = random_vector("common", dim) + random_vector(word, dim)
+    return vectors
+
+
+def build_pipeline(vocab, dim=64):
+    nlp = spacy.blank("en")
+    for word, vector in word_vectors(vocab, dim).items():
+        nlp.vocab.set_vector(word, vector)
+        nlp.vocab.set_vector(word.title(), vector)
+    nlp.add_pipe("espial_bench_parser")
+    return nlp
+
+
+def save_pipeline(vocab, path, dim=64):
+    """
+    Save the pipeline of a vocabulary to `path`, to be used as `Config.model`. It can only be
+    loaded once this module is imported, which registers its component.
+    """
+    path = Path(path)
+    build_pipeline(vocab, dim).to_disk(path)
+    return path
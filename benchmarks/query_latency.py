@@ -0,0 +1,89 @@
+"""
+Compare the latency of the search endpoints depending on how queries are parsed
+(`Config.QUERY`): with the full pipeline, without the components concept matching doesn't
+need, with the concept matcher instead of the pipeline, and vector only. The query and
+results caches are disabled, so that every request parses and searches its query.
+
+    python benchmarks/query_latency.py <data-dir> --queries 200
+
+Queries are the first words of notes from the knowledge base. Prints a JSON list with the
+mean / p95 latency in milliseconds of each endpoint and query mode.
+"""
+import json
+import random
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+from espial import create_app
+from espial.cli import load_config
+
+
+def timed(fn, queries):
+    times = []
+    for q in queries:
+        start = time.perf_counter()
+        resp = fn(q)
+        times.append(time.perf_counter() - start)
+        assert resp.status_code == 200, resp.status_code
+    return {
+        "mean_ms": round(float(np.mean(times)) * 1000, 2),
+        "p95_ms": round(float(np.percentile(times, 95)) * 1000, 2),
+    }
+
+
+def run_mode(client, name, concepts, texts):
+    row = {"mode": name}
+    row["semantic_search"] = timed(
+        lambda q: client.post("/semantic_search", json={"q": q, "concepts": concepts}),
+        texts,
+    )
+    if concepts:
+        row["potential_concepts"] = timed(
+            lambda q: client.post("/potential_concepts", json={"text": q}), texts
+        )
+    click.echo(f"{name}: {row['semantic_search']['mean_ms']} ms per search", err=True)
+    return row
+
+
+@click.command()
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--queries", type=int, default=200, help="Number of queries per mode.")
+@click.option("--words", type=int, default=8, help="Number of words per query.")
+def main(data_dir, queries, words):
+    rng = random.Random(0)
+    paths = sorted(Path(data_dir).rglob("*.md"))
+    texts = [
+        " ".join(path.open("r").read().split()[:words])
+        for path in rng.sample(paths, min(queries, len(paths)))
+    ]
+    texts = [t for t in texts if t]
+
+    results = []
+    for matcher in (False, True):
+        config = load_config(Path(data_dir))
+        config.CACHE["queries"] = 0  # measure searches, not cache hits
+        config.CACHE["results"] = 0
+        config.QUERY["matcher"] = matcher
+        app = create_app(config)
+        app.startup.wait()
+        client = app.test_client()
+        if matcher:
+            modes = [("concept matcher", True, config.QUERY["disable"])]
+        else:
+            modes = [
+                ("full pipeline", True, []),
+                ("concepts", True, config.QUERY["disable"]),
+                ("vector only", False, config.QUERY["disable"]),
+            ]
+        for name, concepts, disable in modes:
+            config.QUERY["disable"] = disable
+            results.append(run_mode(client, name, concepts, texts))
+        if app.watcher is not None:
+            app.watcher.stop()
+    click.echo(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
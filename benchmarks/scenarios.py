@@ -0,0 +1,241 @@
+"""
+Time Espial's hot paths on a synthetic knowledge base, with the offline pipeline of
+benchmarks/pipeline.py so that no model needs to be downloaded.
+
+    python -m benchmarks.scenarios --docs 2000 --repeat 3 --output results.json
+
+Each scenario's setup (eg loading the mesh it runs on) isn't timed. After the timed runs, it
+runs once more under tracemalloc to measure its peak memory, unless `--no-memory` is given.
+Prints, and optionally saves, a JSON object with the vault's parameters and, for each scenario,
+the median and min seconds of its runs, its peak memory in MB and, for the query scenarios,
+the mean milliseconds per call.
+"""
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import click
+from espial.analysis import find_most_sim, parse_query, search_q
+from espial.config import Config
+from espial.load import load_mesh, save_snapshot
+
+from benchmarks import pipeline, synthetic
+
+# files load_mesh keeps in the data dir between runs
+CACHE_FILES = [
+    ".manifest.json",
+    ".annotations",
+    ".doc_annotations",
+    ".graph.json",
+    ".mesh_state",
+    ".mesh_snapshot",
+    ".ann_index",
+]
+
+
+class Bench:
+    """A synthetic vault, its pipeline and queries, and the meshes scenarios run on."""
+
+    def __init__(self, workdir, vault_params, n_queries):
+        self.workdir = Path(workdir)
+        self.vault = self.workdir / "vault"
+        self.vocab = synthetic.generate_vault(self.vault, **vault_params)
+        self.model = pipeline.save_pipeline(self.vocab, self.workdir / "pipeline")
+        self.queries = synthetic.queries(self.vocab, n_queries)
+        self._analyzed = None
+
+    def config(self, rerun=False):
+        config = Config()
+        config.data_dir = self.vault
+        config.model = str(self.model)
+        config.ANALYSIS["rerun"] = int(rerun)
+        # the synthetic topics are small, keep more of their concepts than on real notes
+        config.ANALYSIS["cutoffs"]["min_avg_noun_tf_idf"] = 0.04
+        return config
+
+    def clear_caches(self):
+        for name in CACHE_FILES:
+            path = self.vault / name
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+
+    def analyze(self, config):
+        """Load, filter and trim the mesh like create_app does on a first run."""
+        mesh, nlp, rerun = load_mesh(config)
+        mesh.remove_irrelevant_edges()
+        mesh.trim_all()
+        mesh.save_state(self.vault / ".mesh_state")
+        save_snapshot(mesh, config)
+        return mesh, nlp
+
+    def analyzed(self):
+        """The analyzed mesh that read-only scenarios share, with its pipeline."""
+        if self._analyzed is None:
+            self._analyzed = self.analyze(self.config(rerun=True))
+        return self._analyzed
+
+    def parsed_queries(self):
+        mesh, nlp = self.analyzed()
+        return [parse_query(nlp, q, mesh.concept_matcher is None) for q in self.queries]
+
+
+def load_mesh_cold(bench):
+    bench.clear_caches()
+    config = bench.config()
+    return lambda: load_mesh(config)
+
+
+def load_mesh_warm(bench):
+    config = bench.config()
+    config.ANALYSIS["snapshot"] = False  # restore the saved state from the parsed docs
+    if not (bench.vault / ".mesh_state").exists():
+        bench.analyze(config)
+    return lambda: load_mesh(config)
+
+
+def load_mesh_snapshot(bench):
+    config = bench.config()
+    if not (bench.vault / ".mesh_snapshot").exists():
+        bench.analyze(config)
+    return lambda: load_mesh(config)
+
+
+def remove_irrelevant_edges(bench):
+    mesh, nlp, rerun = load_mesh(bench.config(rerun=True))
+    return mesh.remove_irrelevant_edges
+
+
+def trim_all(bench):
+    mesh, nlp, rerun = load_mesh(bench.config(rerun=True))
+    mesh.remove_irrelevant_edges()
+    return mesh.trim_all
+
+
+def display_graph(bench):
+    mesh, nlp = bench.analyzed()
+    return lambda: mesh.display_graph(mesh.conf["max_concepts"])
+
+
+def search(bench):
+    mesh, nlp = bench.analyzed()
+    queries = bench.parsed_queries()
+    search_q(mesh, queries[0])  # builds the concept matcher
+    return lambda: [search_q(mesh, q) for q in queries]
+
+
+def most_sim(bench):
+    mesh, nlp = bench.analyzed()
+    ids = list(mesh.doc_vectors.rows)[: len(bench.queries)]
+    return lambda: [find_most_sim(mesh, id) for id in ids]
+
+
+def existing_doc_concepts(bench):
+    mesh, nlp = bench.analyzed()
+    queries = bench.parsed_queries()
+    mesh.get_existing_doc_concepts(queries[0])
+    return lambda: [mesh.get_existing_doc_concepts(q) for q in queries]
+
+
+# name -> setup(bench) returning the function to time, and whether it makes one call per query
+# and returns their results
+SCENARIOS = {
+    "load_mesh_cold": (load_mesh_cold, False),
+    "load_mesh_warm": (load_mesh_warm, False),
+    "load_mesh_snapshot": (load_mesh_snapshot, False),
+    "remove_irrelevant_edges": (remove_irrelevant_edges, False),
+    "trim_all": (trim_all, False),
+    "display_graph": (display_graph, False),
+    "search_q": (search, True),
+    "find_most_sim": (most_sim, True),
+    "get_existing_doc_concepts": (existing_doc_concepts, True),
+}
+
+
+def run_scenario(bench, name, repeat, memory):
+    setup, per_query = SCENARIOS[name]
+    times = []
+    for _ in range(repeat):
+        fn = setup(bench)
+        start = time.perf_counter()
+        calls = fn()
+        times.append(time.perf_counter() - start)
+    result = {
+        "scenario": name,
+        "runs": repeat,
+        "seconds": round(statistics.median(times), 4),
+        "min_seconds": round(min(times), 4),
+    }
+    if per_query:
+        result["ms_per_call"] = round(statistics.median(times) / len(calls) * 1000, 3)
+    if memory:
+        fn = setup(bench)
+        tracemalloc.start()
+        fn()
+        result["peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 2)
+        tracemalloc.stop()
+    return result
+
+
+@click.command()
+@click.option("--docs", type=int, default=1000, help="Number of notes in the vault.")
+@click.option("--topics", type=int, default=8)
+@click.option("--topic-words", type=int, default=30, help="Vocabulary size of each topic.")
+@click.option("--entities", type=int, default=20)
+@click.option("--doc-words", type=(int, int), default=(20, 120), help="Min and max words per note.")
+@click.option("--focus", type=float, default=0.6, help="Share of a note's words from its topic.")
+@click.option("--seed", type=int, default=0)
+@click.option("--queries", type=int, default=100, help="Calls of the query scenarios per run.")
+@click.option("--repeat", type=int, default=3, help="Timed runs of each scenario.")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)), help="Scenarios to run, all of them by default.")
+@click.option("--no-memory", is_flag=True, help="Don't measure peak memory.")
+@click.option("--workdir", type=click.Path(), help="Where to generate the vault, kept after the run.")
+@click.option("--output", type=click.Path(), help="Also save the results to this file.")
+def main(docs, topics, topic_words, entities, doc_words, focus, seed, queries, repeat, scenarios, no_memory, workdir, output):
+    vault_params = {
+        "n_docs": docs,
+        "n_topics": topics,
+        "topic_words": topic_words,
+        "n_entities": entities,
+        "doc_words": doc_words,
+        "focus": focus,
+        "seed": seed,
+    }
+    tmp_dir = None
+    if workdir is None:
+        workdir = tmp_dir = tempfile.mkdtemp(prefix="espial-bench-")
+    try:
+        with redirect_stdout(sys.stderr):  # keep the progress of load_mesh out of the report
+            bench = Bench(workdir, vault_params, queries)
+            results = [
+                run_scenario(bench, name, repeat, not no_memory)
+                for name in scenarios or SCENARIOS
+            ]
+            mesh, nlp = bench.analyzed()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    report = {
+        "vault": dict(vault_params, queries=queries),
+        "mesh": {
+            "docs": len(mesh.doc_vectors.rows),
+            "concepts": len(mesh.concept_cache),
+            "links": mesh.number_of_edges(),
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Measure the throughput of the search endpoints of `espial serve` depending on its number of
+worker processes, on a synthetic knowledge base (see benchmarks/synthetic.py).
+
+    python -m benchmarks.serve_throughput --workers 1 --workers 2 --workers 4 --clients 16
+
+For each worker count, a server is started and `clients` processes send queries to
+/semantic_search and /most_sim for `duration` seconds. Result caches are disabled so that
+every request is computed. Prints a JSON list with the requests/sec and the median / p95
+latency in milliseconds reached with each worker count.
+"""
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import numpy as np
+import requests
+
+from benchmarks import pipeline, synthetic
+
+CONFIG = """\
+import benchmarks.pipeline  # registers the component of the offline pipeline
+from espial.config import Config
+
+class Config(Config):
+    def __init__(self):
+        super().__init__()
+        self.model = {model!r}
+        self.ANALYSIS["cutoffs"]["min_avg_noun_tf_idf"] = 0.04
+        self.CACHE["queries"] = 0  # measure searches, not cache hits
+        self.CACHE["results"] = 0
+"""
+
+
+def start_server(vault, workers, port, log):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get("PYTHONPATH")])))
+    return subprocess.Popen(
+        [sys.executable, "-c", "from espial.cli import espial; espial()", "serve", str(vault), "--workers", str(workers), "--port", str(port)],
+        stdout=log,
+        stderr=log,
+        env=env,
+    )
+
+
+def wait_ready(url, server, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited, see its log")
+        try:
+            if requests.get(f"{url}/status", timeout=1).json()["ready"]:
+                return
+        except (requests.RequestException, ValueError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError("The server didn't start in time")
+
+
+def client(args):
+    """Send requests until `duration` is over, returns their latencies and the number of errors."""
+    url, queries, doc_ids, endpoints, duration, seed = args
+    rng = random.Random(seed)
+    session = requests.Session()
+    latencies, errors = [], 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        endpoint = rng.choice(endpoints)
+        start = time.perf_counter()
+        if endpoint == "semantic_search":
+            resp = session.post(f"{url}/semantic_search", json={"q": rng.choice(queries)})
+        else:
+            resp = session.get(f"{url}/most_sim/{rng.choice(doc_ids)}")
+        latencies.append(time.perf_counter() - start)
+        errors += resp.status_code != 200
+    return latencies, errors
+
+
+@click.command()
+@click.option("--workers", type=int, multiple=True, default=[1, 2, 4], help="Worker counts to compare.")
+@click.option("--clients", type=int, default=8, help="Processes sending requests at once.")
+@click.option("--duration", type=float, default=10, help="Seconds of load per worker count.")
+@click.option("--docs", type=int, default=2000, help="Number of notes in the synthetic vault.")
+@click.option("--endpoint", "endpoints", multiple=True, type=click.Choice(["semantic_search", "most_sim"]), default=["semantic_search", "most_sim"])
+@click.option("--port", type=int, default=5102)
+@click.option("--workdir", type=click.Path(), help="Where to generate the vault, kept after the run.")
+def main(workers, clients, duration, docs, endpoints, port, workdir):
+    tmp_dir = None
+    if workdir is None:
+        workdir = tmp_dir = tempfile.mkdtemp(prefix="espial-bench-")
+    workdir = Path(workdir)
+    vault = workdir / "vault"
+    vocab = synthetic.generate_vault(vault, n_docs=docs)
+    model = pipeline.save_pipeline(vocab, workdir / "pipeline")
+    (vault / "espial.py").write_text(CONFIG.format(model=str(model)))
+    queries = synthetic.queries(vocab, 1000)
+    url = f"http://127.0.0.1:{port}"
+    results = []
+    try:
+        for n_workers in workers:
+            with (workdir / f"serve-{n_workers}.log").open("w") as log:
+                server = start_server(vault, n_workers, port, log)
+                try:
+                    wait_ready(url, server)
+                    hits = requests.post(f"{url}/semantic_search", json={"q": queries[0], "top_n": 50}).json()
+                    doc_ids = [hit["id"] for hit in hits]
+                    with multiprocessing.Pool(clients) as pool:
+                        runs = pool.map(
+                            client,
+                            [(url, queries, doc_ids, list(endpoints), duration, seed) for seed in range(clients)],
+                        )
+                finally:
+                    server.send_signal(signal.SIGTERM)
+                    server.wait()
+            latencies = np.concatenate([np.array(latencies) for latencies, _ in runs])
+            results.append(
+                {
+                    "workers": n_workers,
+                    "clients": clients,
+                    "requests": len(latencies),
+                    "errors": sum(errors for _, errors in runs),
+                    "req_per_s": round(len(latencies) / duration, 1),
+                    "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 2),
+                    "p95_ms": round(float(np.percentile(latencies, 95)) * 1000, 2),
+                }
+            )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Synthetic knowledge bases for the benchmarks.
+
+Notes are written about one topic each: most of their words come from the topic's vocabulary,
+the others are common words, named entities ("Kalocorp Mitaing") and words of other topics.
+Words are made of syllables, so vaults of any size can be generated without a corpus, and the
+same parameters always produce the same vault.
+"""
+import json
+import math
+import random
+from pathlib import Path
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "ta", "vo", "zi", "pe", "du", "sa", "bo"]
+COMMON_WORDS = ["thing", "things", "idea", "ideas", "system", "systems", "notes", "way", "work"]
+
+
+def make_word(i, n_syllables=3, suffix=""):
+    """The i-th word of `n_syllables` syllables, distinct words for distinct `i` < 12 ** n."""
+    word = ""
+    for _ in range(n_syllables):
+        word += SYLLABLES[i % len(SYLLABLES)]
+        i //= len(SYLLABLES)
+    return word + suffix
+
+
+def vocabulary(n_topics=8, topic_words=30, n_entities=20):
+    """
+    The words of a vault: a dict with the `topics` (lists of words), `entities` (two-word
+    names), and the `common` words.
+    """
+    n_syllables = max(3, math.ceil(math.log(n_topics * topic_words, len(SYLLABLES))))
+    topics = [
+        [make_word(t * topic_words + i, n_syllables, "ion") for i in range(topic_words)]
+        for t in range(n_topics)
+    ]
+    name_syllables = max(2, math.ceil(math.log(2 * n_entities, len(SYLLABLES))))
+    entities = [
+        f"{make_word(i, name_syllables).title()}corp "
+        f"{make_word(i + n_entities, name_syllables).title()}ing"
+        for i in range(n_entities)
+    ]
+    return {"topics": topics, "entities": entities, "common": list(COMMON_WORDS)}
+
+
+def generate_vault(
+    path,
+    n_docs=1000,
+    n_topics=8,
+    topic_words=30,
+    n_entities=20,
+    doc_words=(20, 120),
+    focus=0.6,
+    seed=0,
+):
+    """
+    Write `n_docs` markdown notes of `doc_words` words (min, max) to `path`. A share `focus` of
+    each note's words comes from its topic. The vocabulary is saved with the notes as
+    `.vocabulary.json`, see `load_vocabulary`, and returned.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    vocab = vocabulary(n_topics, topic_words, n_entities)
+    topics, entities, common = vocab["topics"], vocab["entities"], vocab["common"]
+    other = (1 - focus) / 3  # common words, entities and words of other topics
+    for d in range(n_docs):
+        topic = topics[rng.randrange(n_topics)]
+        words = []
+        for _ in range(rng.randint(*doc_words)):
+            r = rng.random()
+            if r < focus:
+                words.append(rng.choice(topic))
+            elif r < focus + other:
+                words.append(rng.choice(common))
+            elif r < focus + 2 * other:
+                words.append(rng.choice(entities))
+            else:
+                words.append(rng.choice(rng.choice(topics)))
+        with (path / f"note{d}.md").open("w") as f:
+            f.write(f"# Note {d}\n{' '.join(words)}.\n")
+    with (path / ".vocabulary.json").open("w") as f:
+        json.dump(vocab, f)
+    return vocab
+
+
+def load_vocabulary(path):
+    with (Path(path) / ".vocabulary.json").open("r") as f:
+        return json.load(f)
+
+
+def queries(vocab, n=100, n_words=6, seed=1):
+    """Search queries mixing the words of a topic with an entity or a common word."""
+    rng = random.Random(seed)
+    results = []
+    for _ in range(n):
+        words = rng.sample(rng.choice(vocab["topics"]), n_words - 1)
+        words.append(rng.choice(vocab["entities"] + vocab["common"]))
+        rng.shuffle(words)
+        results.append(" ".join(words))
+    return results
@@ -1,14 +1,22 @@
+import os
 import time
-import json
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from pathlib import Path
 from espial.config import Config
 from os import urandom
 
 import flask
 from flask_cors import CORS
-import networkx
 from flask import request, jsonify
-from espial.load import load_mesh
+from espial.cache import ResultCache
+from espial.fetch import ArticleFetcher
+from espial.jobs import JobRunner
+from espial.load import load_mesh, save_snapshot
+from espial.metrics import RequestProfiler, metrics, resident_bytes
+from espial.startup import Startup
+from espial.watch import MeshUpdater, ReadWriteLock, Watcher
 from espial.analysis import *
 
 
@@ -17,112 +25,372 @@ def create_app(config=Config()):
     app.secret_key = urandom(24)
     CORS(app, origins=config.ALLOWED_ORIGINS)
     data_dir = Path(config.data_dir)
-    mesh, nlp, rerun = load_mesh(config)
-    trim1 = time.time()
-    if rerun:
-        print(
-            f"{mesh.graph.number_of_edges()} number of doc-concept links before sanitization. {len(mesh.concept_cache)} concepts."
+    mesh = nlp = None  # set by the load stage
+    lock = ReadWriteLock()  # views hold it while they read the mesh, the watcher to swap changed docs in
+    app.mesh_lock = lock
+    app.watcher = None  # watches the notes once the mesh is loaded, with WATCH["enabled"]
+    app.update_hooks = []  # called after the watcher changed the mesh, eg by espial/serve.py
+    startup = Startup(["load", "filter", "trim", "export", "warmup"])
+    app.startup = startup
+    caches = {
+        name: ResultCache(config.CACHE[name], config.CACHE["ttl"])
+        for name in ("queries", "articles", "results")
+    }
+    app.caches = caches
+    fetcher = ArticleFetcher.from_config(config)
+    profiler = None  # profiles slow requests, see METRICS in the config
+    if config.METRICS["profile"]:
+        profiler = RequestProfiler(
+            data_dir / ".profiles",
+            config.METRICS["profile"],
+            config.METRICS["profile_min_seconds"],
         )
-        mesh.remove_irrelevant_edges()
-        print(
-            mesh.graph.number_of_edges(),
-            "number of doc-concept links after tf-idf pre-processing",
+
+    graph_path = data_dir.absolute() / "graph.json"
+    graph_etags = ResultCache(4, float("inf"))  # (inode, mtime) of a graph file -> its sha256
+    jobs = JobRunner()  # bulk concept notes and tags, see /jobs
+
+    def export_graph():
+        mesh.save_graph(graph_path, config.ANALYSIS["max_concepts"])
+
+    def file_etag(f):
+        """
+        ETag of the open file `f`, the sha256 of its bytes. Exports rename new files over the
+        graph, so the file that is open always matches its ETag, in every worker.
+        """
+        stat = os.fstat(f.fileno())
+
+        def digest():
+            hash = sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hash.update(chunk)
+            f.seek(0)
+            return hash.hexdigest()
+
+        return graph_etags.get_or_set((stat.st_ino, stat.st_mtime_ns), digest), stat.st_size
+
+    def save_state():
+        """Save the analyzed mesh, for the next start to only analyze the notes that changed."""
+        if config.ANALYSIS["incremental"]["enabled"]:
+            mesh.save_state(data_dir / ".mesh_state")
+            save_snapshot(mesh, config)
+
+    def start():
+        """
+        Slow startup work, run in the background so that the server can answer while it runs.
+        Views that need data which isn't ready yet degrade or answer 503, see `requires`.
+        """
+        nonlocal mesh, nlp
+        mesh, nlp, rerun = startup.run(
+            "load", load_mesh, config, startup.progress("load")
+        )
+        trim1 = time.time()
+        if rerun:
+            print(
+                f"{mesh.number_of_edges()} number of doc-concept links before sanitization. {len(mesh.concept_cache)} concepts."
+            )
+            startup.run("filter", mesh.remove_irrelevant_edges)
+            print(
+                mesh.number_of_edges(),
+                "number of doc-concept links after tf-idf pre-processing",
+            )
+            trim2 = time.time()
+            print(
+                f"time spent to remove irrelevant edges: edges [{mesh.number_of_edges()}]",
+                trim2 - trim1,
+            )
+            startup.run("trim", mesh.trim_all)
+            print(time.time() - trim2, "time spent to remove all uninteresting concepts")
+            save_state()
+        else:
+            startup.skip("filter")
+            startup.skip("trim")
+        print(len(mesh.concept_cache), "number of concepts found")
+        print(mesh.number_of_edges(), "number of edges left")
+
+        startup.run("export", export_graph)
+        startup.run(
+            "warmup", lambda: search_q(mesh, parse_query(nlp, "test", needs_parse(True)))
+        )  # prep search server up (and build the concept matcher) - makes results faster
+
+        if config.WATCH["enabled"]:
+
+            def on_update():
+                save_state()
+                export_graph()
+                for hook in app.update_hooks:
+                    hook()
+
+            app.watcher = Watcher(config, MeshUpdater(mesh, nlp, config, lock, on_update))
+            app.watcher.start()
+
+    def run_startup():
+        try:
+            start()
+        finally:
+            startup.finished.set()
+
+    def requires(stage, api=False):
+        """Only serve a view once the given startup stage is done."""
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if startup.ready(stage):
+                    return view(*args, **kwargs)
+                if api:
+                    resp = jsonify({"error": "Espial is starting up", "status": startup.status()})
+                    resp.status_code = 503
+                    resp.headers["Retry-After"] = "5"
+                    return resp
+                flask.flash("Espial is still analyzing your notes, try again in a moment", "error")
+                return flask.redirect(flask.url_for("index"))
+
+            return wrapper
+
+        return decorator
+
+    def query_concepts(requested):
+        """Whether a query should be matched with concepts."""
+        if requested is None:
+            requested = config.QUERY["concepts"]
+        elif isinstance(requested, str):
+            requested = requested.lower() not in ("0", "false", "no")
+        return bool(requested) and startup.ready("trim")
+
+    def needs_parse(concepts):
+        """Whether queries must be parsed to find their concepts, see espial/matcher.py."""
+        return concepts and mesh.concept_matcher is None
+
+    def cached_query(q, concepts):
+        """Parsed query, which doesn't depend on the mesh."""
+        parse, disable = needs_parse(concepts), config.QUERY["disable"]
+        return caches["queries"].get_or_set(
+            (q, parse, tuple(disable)), lambda: parse_query(nlp, q, parse, disable)
         )
-        trim2 = time.time()
-        print(
-            f"time spent to remove irrelevant edges: edges [{mesh.graph.number_of_edges()}]",
-            trim2 - trim1,
+
+    def cached_most_sim(id, top_n=10, concepts=True):
+        return caches["results"].get_or_set(
+            ("most_sim", id, top_n, concepts, mesh.version),
+            lambda: find_most_sim(mesh, id, top_n, concepts=concepts),
+        )
+
+    def with_links(hits):
+        """Copies of cached hits with links to the docs."""
+        return [dict(doc, link=config.get_link(mesh.doc_cache[doc["id"]])) for doc in hits]
+
+    @app.before_request
+    def start_request():
+        flask.g.request_start = time.perf_counter()
+        flask.g.profiler = profiler.start() if profiler is not None else None
+
+    @app.after_request
+    def record_request(resp):
+        seconds = time.perf_counter() - flask.g.request_start
+        endpoint = request.endpoint or "not_found"
+        metrics.observe("espial_request_duration_seconds", seconds, (("endpoint", endpoint),))
+        metrics.inc(
+            "espial_requests_total", (("endpoint", endpoint), ("status", str(resp.status_code)))
         )
-        mesh.trim_all()
-        print(time.time() - trim2, "time spent to remove all uninteresting concepts")
-    print(len(mesh.concept_cache), "number of concepts found")
-    print(mesh.graph.number_of_edges(), "number of edges left")
-    json_graph = networkx.json_graph.node_link_data(
-        mesh.display_graph(config.ANALYSIS["max_concepts"])
-    )
-    json.dump(json_graph, (data_dir / "graph.json").open("w"))
-    json.dump(json_graph, (Path(app.root_path) / "static/force.json").open("w"))
-    search_q(mesh, nlp("test"))  # prep search server up - makes results faster
+        if flask.g.profiler is not None:
+            path = profiler.stop(
+                flask.g.profiler, endpoint, seconds, force=bool(request.args.get("profile"))
+            )
+            if path is not None:
+                print(f"Saved the profile of a {seconds:.3f}s request to {endpoint} to {path}")
+        return resp
+
+    @app.route("/status")
+    def status():
+        return jsonify(startup.status())
+
+    @app.route("/cache_stats")
+    def cache_stats():
+        stats = {name: cache.stats() for name, cache in caches.items()}
+        stats["article_fetches"] = fetcher.stats()
+        return jsonify(stats)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        """Timings of the startup stages and requests, and the size of the mesh, for Prometheus."""
+        if startup.ready("load"):
+            with lock.read():
+                metrics.set("espial_docs", len(mesh.doc_vectors.rows))
+                metrics.set("espial_concepts", len(mesh.concept_cache))
+                metrics.set("espial_edges", mesh.number_of_edges())
+        for name, cache in caches.items():
+            stats, labels = cache.stats(), (("cache", name),)
+            metrics.set("espial_cache_entries", stats["entries"], labels)
+            metrics.set("espial_cache_hits_total", stats["hits"], labels)
+            metrics.set("espial_cache_misses_total", stats["misses"], labels)
+        metrics.set("process_resident_memory_bytes", resident_bytes())
+        return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
     @app.route("/")
     def index():
-        return flask.render_template(
-            "index.html", title="Graph", n_nodes=len(mesh.graph.nodes)
-        )
+        n_nodes = 0
+        if startup.ready("load"):
+            with lock.read():
+                n_nodes = mesh.number_of_nodes()
+        else:
+            flask.flash("Espial is still loading your notes", "info")
+        return flask.render_template("index.html", title="Graph", n_nodes=n_nodes)
 
     @app.route("/graph")
+    @requires("export", api=True)
     def concept_graph():
-        return flask.render_template("force.html", n_nodes=len(mesh.graph.nodes))
+        """
+        Node-link JSON of the graph shown on the index, gzipped if the client accepts it.
+        Clients revalidate it with its ETag, so reloads that didn't change cost a 304.
+        """
+        gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+        path = graph_path.with_name("graph.json.gz") if gzipped else graph_path
+        f = path.open("rb")
+        etag, size = file_etag(f)
+        resp = flask.send_file(
+            f, mimetype="application/json", etag=etag, conditional=True, max_age=0
+        )
+        resp.call_on_close(f.close)  # a 304 doesn't send the file, which must be closed anyway
+        if resp.status_code == 200:
+            resp.content_length = size
+        resp.cache_control.no_cache = True
+        resp.vary.add("Accept-Encoding")
+        if gzipped and resp.status_code == 200:
+            resp.headers["Content-Encoding"] = "gzip"
+        return resp
 
     @app.route("/most_sim/<id>")
+    @requires("load", api=True)
     def find_sim(id):
-        if not id in mesh.graph or "score" in mesh.graph.nodes[id]:
-            flask.flash("Document not found", "error")
-            return flask.redirect(flask.url_for('index'))
-        top_n = request.args.get("top_n", 10)
-        return jsonify(find_most_sim(mesh, id, top_n))
+        top_n = int(request.args.get("top_n", 10))
+        with lock.read():
+            if not mesh.has_doc(id):
+                flask.flash("Document not found", "error")
+                return flask.redirect(flask.url_for('index'))
+            hits = cached_most_sim(id, top_n, concepts=startup.ready("trim"))
+        return jsonify(hits)
 
     @app.route("/best_tags")
+    @requires("trim", api=True)
     def get_most_relevant_tags():
         top_n = int(request.args.get("top_n", 30))
         only_ents = request.args.get("only_ents", False)
-        return jsonify(most_relevant_tags(mesh, top_n, only_ents))
+        with lock.read():
+            tags = most_relevant_tags(mesh, top_n, only_ents)
+        return jsonify(tags)
 
     @app.route("/concept/<concept>")
+    @requires("trim")
     def view_concept(concept):
-        if not concept in mesh.graph or not "score" in mesh.graph.nodes[concept]:
-            flask.flash("Concept not found", "error")
-            return flask.redirect(flask.url_for('index'))
-        concept_node = mesh.graph.nodes[concept]
+        with lock.read():
+            if not concept in mesh.concept_cache:
+                flask.flash("Concept not found", "error")
+                return flask.redirect(flask.url_for('index'))
+            concept_node = mesh.concept_info(concept)
 
-        related_docs = list(
-            map(
-                lambda x: (x[0], mesh.doc_cache[x[0]]._.title),
-                mesh.graph.in_edges(concept),
+            related_docs = list(
+                map(
+                    lambda x: (x, mesh.doc_cache[x]._.title),
+                    mesh.concept_docs(concept),
+                )
             )
-        )
         return flask.render_template(
             "show_concept.html", title=concept, concept=concept_node, docs=related_docs
         )
 
     @app.route("/doc/<id>")
+    @requires("load")
     def view_doc(id):
-        if not id in mesh.graph or "score" in mesh.graph.nodes[id]:
+        with lock.read():
+            if not mesh.has_doc(id):
+                flask.flash("Document not found", "error")
+                return flask.redirect(flask.url_for('index'))
+            concepts = startup.ready("trim")  # concepts are still being filtered otherwise
+            tags = mesh.doc_concepts(id) if concepts else []
+            most_sim = cached_most_sim(id, concepts=concepts)
+            title = mesh.doc_cache[id]._.title
+        try:
+            doc = mesh.doc_cache.doc(id)  # may be read from the store, outside the lock
+        except KeyError:  # removed by the watcher meanwhile
             flask.flash("Document not found", "error")
             return flask.redirect(flask.url_for('index'))
-        tags = list(map(lambda x: x[1], mesh.graph.out_edges(id)))
-        most_sim = find_most_sim(mesh, id)
         return flask.render_template(
-            "show_doc.html",
-            doc=mesh.doc_cache[id],
-            tags=tags,
-            title=mesh.doc_cache[id]._.title,
-            most_sim=most_sim,
+            "show_doc.html", doc=doc, tags=tags, title=title, most_sim=most_sim
         )
 
     @app.route("/semantic_search", methods=["POST"])
+    @requires("load", api=True)
     def search_endpoint():
         q = request.json.get("q")
         top_n = int(request.json.get("top_n", 10))
         if not q:
             return flask.redirect(flask.url_for('index'))
-        res = search_q(mesh, nlp(q), top_n)
-        for doc in res:
-            doc["link"] = config.get_link(mesh.doc_cache[doc["id"]])
-        return jsonify(res)
+        concepts = query_concepts(request.json.get("concepts"))
+        q_doc = cached_query(q, concepts)
+        with lock.read():
+            res = caches["results"].get_or_set(
+                ("search", q, top_n, concepts, mesh.version),
+                lambda: search_q(mesh, q_doc, top_n, concepts=concepts),
+            )
+            hits = with_links(res)
+        return jsonify(hits)
+
+    @app.route("/batch_search", methods=["POST"])
+    @requires("load", api=True)
+    def batch_search_endpoint():
+        body = request.json
+        queries = (body.get("queries") or []) if isinstance(body, dict) else None
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            resp = jsonify({"error": "queries must be a list of strings"})
+            resp.status_code = 400
+            return resp
+        top_n = int(body.get("top_n", 10))
+        if len(queries) > config.QUERY["max_batch"]:
+            resp = jsonify(
+                {"error": f"At most {config.QUERY['max_batch']} queries can be searched at once"}
+            )
+            resp.status_code = 413
+            return resp
+        concepts = query_concepts(body.get("concepts"))
+        version = mesh.version
+        results = [caches["results"].get(("search", q, top_n, concepts, version)) for q in queries]
+        todo = [i for i, res in enumerate(results) if res is None and queries[i]]
+        q_docs = parse_queries(
+            nlp, [queries[i] for i in todo], needs_parse(concepts), config.QUERY["disable"]
+        )
+        with lock.read():
+            version = mesh.version  # results are cached for the mesh they were computed on
+            for i, res in zip(todo, search_batch(mesh, q_docs, top_n, concepts=concepts)):
+                caches["results"].set(("search", queries[i], top_n, concepts, version), res)
+                results[i] = res
+            hits = [with_links(res or []) for res in results]
+        return jsonify(hits)
 
     @app.route("/search")
     def search_view():
         return flask.render_template("/search.html", title="Search")
 
     @app.route("/article_search")
+    @requires("load", api=True)
     def compare_article():
         url = request.args.get("url")
         top_n = int(request.args.get("top_n", 10))
-        article = load_url(url, nlp)
-        hits = search_q(mesh, article, top_n)
-        for doc in hits:
-            doc["link"] = config.get_link(mesh.doc_cache[doc["id"]])
+        concepts = query_concepts(request.args.get("concepts"))
+        parse, disable = needs_parse(concepts), config.QUERY["disable"]
+        article = caches["articles"].get_or_set(
+            (url, parse, tuple(disable)),
+            lambda: load_url(url, nlp, parse, disable, fetcher),
+        )
+        if not article:
+            resp = jsonify({"error": f"Could not fetch {url}"})
+            resp.status_code = 502
+            return resp
+        with lock.read():  # the article was fetched and parsed without holding the lock
+            hits = caches["results"].get_or_set(
+                ("article", url, top_n, concepts, mesh.version),
+                lambda: search_q(mesh, article, top_n, concepts=concepts),
+            )
+            hits = with_links(hits)
         resp = {
             "hits": hits,
             "article": {"title": article._.title, "text": article.text},
@@ -130,20 +398,26 @@ def create_app(config=Config()):
         return jsonify(resp)
 
     @app.route("/create_tag/<concept>")
+    @requires("trim")
     def make_tag(concept):
-        if not concept in mesh.concept_cache:
-            flask.flash("Concept not found", "error")
-            return flask.redirect(flask.url_for('index'))
-        config.create_tag(concept, mesh)
+        with lock.read():
+            if not concept in mesh.concept_cache:
+                flask.flash("Concept not found", "error")
+                return flask.redirect(flask.url_for('index'))
+            job = config.create_tags([concept], mesh)
+        job.run()  # rewrites the files without holding the lock
         flask.flash("Tag created", "success")
         return flask.redirect(flask.url_for('view_concept', concept=concept))
 
     @app.route("/create_concept_note/<concept>")
+    @requires("trim")
     def concept_note(concept):
-        if not concept in mesh.concept_cache:
-            flask.flash("Concept not found", "error")
-            return flask.redirect(flask.url_for('index'))
-        config.create_concept_note(concept, mesh)
+        with lock.read():
+            if not concept in mesh.concept_cache:
+                flask.flash("Concept not found", "error")
+                return flask.redirect(flask.url_for('index'))
+            job = config.create_concept_notes([concept], mesh)
+        job.run()
         flask.flash("Concept note created", "success")
         return flask.redirect(flask.url_for('view_concept', concept=concept))
 
@@ -155,23 +429,65 @@ def create_app(config=Config()):
     #    f.write(mesh.dbg)
 
     @app.route("/create_all_concept_notes")
+    @requires("trim")
     def create_all_concept_notes():
-        for concept in mesh.concept_cache:
-            config.create_concept_note(concept, mesh)
-        flask.flash("All concept notes created", "success")
+        """Create the note of every concept in the background, see /jobs."""
+        with lock.read():  # the notes are built from the mesh, then written in the background
+            job = config.create_concept_notes(list(mesh.concept_cache), mesh)
+        if jobs.start(job):
+            flask.flash(f"Creating {len(job.items)} concept notes", "success")
+        else:
+            flask.flash("Concept notes are already being created", "error")
         return flask.redirect(flask.url_for('misc_page'))
 
     @app.route("/create_all_tags")
+    @requires("trim")
     def create_all_tags():
-        for concept in mesh.concept_cache:
-            config.create_tag(concept, mesh)
-        flask.flash("All tags created", "success")
+        """
+        Create the tags of every concept in the background, see /jobs.
+        With `dry_run`, answer with the diff of the changes instead of making them.
+        """
+        dry_run = bool(request.args.get("dry_run"))
+        with lock.read():  # the edits are computed from the mesh, the files are read without it
+            job = config.create_tags(list(mesh.concept_cache), mesh, dry_run=dry_run)
+        if dry_run:
+            return flask.Response(job.run().diff(), mimetype="text/plain")
+        if jobs.start(job):
+            flask.flash(f"Creating tags in {len(job.items)} notes", "success")
+        else:
+            flask.flash("Tags are already being created", "error")
         return flask.redirect(flask.url_for('misc_page'))
 
+    @app.route("/jobs")
+    def jobs_status():
+        """Progress of the last bulk job of each kind."""
+        return jsonify(jobs.status())
+
+    @app.route("/jobs/<name>")
+    def job_status(name):
+        job = jobs.get(name)
+        if job is None:
+            resp = jsonify({"error": f"No {name} job was started"})
+            resp.status_code = 404
+            return resp
+        return jsonify(job.status())
+
+    @app.route("/tag_status")
+    def tag_status():
+        """Progress of the last tags job, same as /jobs/tags but idle before the first one."""
+        job = jobs.get("tags")
+        return jsonify(job.status() if job is not None else {"state": "idle"})
+
     @app.route("/potential_concepts", methods=["POST"])
+    @requires("trim", api=True)
     def get_potential_concepts():
         text = request.json.get("text")
         if not text:
             return jsonify([])
-        return jsonify(list(mesh.get_existing_doc_concepts(nlp(text))))
+        doc = cached_query(text, True)
+        with lock.read():
+            concepts = list(mesh.get_existing_doc_concepts(doc))
+        return jsonify(concepts)
+
+    ThreadPoolExecutor(max_workers=1, thread_name_prefix="espial-startup").submit(run_startup)
     return app
@@ -1,87 +1,174 @@
-from html2text import html2text
-from readability import Document
-import requests
 import re
+import numpy as np
+from espial.datastruct import normalize, top_k
+from espial.fetch import ArticleFetcher
 
 
 def most_relevant_tags(mesh, n_tags=30, entities=False):
     """This method needs work - current heuristics remain flawed."""
     concept_avgs = [
-        {"name": concept, "relevance": mesh.graph.nodes[concept]["score"]}
-        for concept in mesh.concept_cache.keys()
+        {"name": concept, "relevance": float(mesh.concept_score.data[cid])}
+        for concept, cid in mesh.concept_cache.items()
     ]
     if entities:  # only return entities
         concept_avgs = list(
-            filter(lambda x: mesh.graph.nodes[x["name"]]["is_ent"], concept_avgs)
+            filter(lambda x: mesh.concept_info(x["name"])["is_ent"], concept_avgs)
         )
     concept_avgs.sort(key=lambda x: x["relevance"], reverse=True)
     for i in range(min(len(concept_avgs), n_tags)):
         in_docs = list(
             map(
-                lambda x: mesh.doc_cache[x[0]]._.title,
-                mesh.graph.in_edges(concept_avgs[i]["name"]),
+                lambda x: mesh.doc_cache[x]._.title,
+                mesh.concept_docs(concept_avgs[i]["name"]),
             )
         )
         concept_avgs[i]["in_docs"] = in_docs
     return concept_avgs[: min(n_tags, len(concept_avgs) - 1)]
 
 
-def find_most_sim(mesh, doc_id, top_n=10):
-    """Find documents most similar to the given document."""
-    doc = mesh.doc_cache[doc_id]
+def doc_similarities(mesh, vector):
+    """
+    Similarity of a vector to the documents of the mesh, and the mask of documents that were scored.
+    In approximate search mode, only documents in the closest clusters of the ANN index are scored.
+    """
+    vectors = mesh.doc_vectors
+    if not vectors.ids or mesh.ann_index is None or mesh.conf["search"]["mode"] != "approximate":
+        return vectors.similarities(vector), vectors.alive_mask.copy()
+    rows = mesh.ann_index.candidates(vector, vectors)
+    sims = np.zeros(len(vectors.ids), dtype=np.float32)
+    sims[rows] = vectors.matrix[rows] @ normalize(vector)
+    candidates = np.zeros(len(vectors.ids), dtype=bool)
+    candidates[rows] = True
+    return sims, candidates
+
+
+def find_most_sim(mesh, doc_id, top_n=10, concepts=True):
+    """
+    Find documents most similar to the given document.
+    With `concepts=False`, the concepts they share aren't listed (eg while they are being filtered).
+    """
+    vectors = mesh.doc_vectors
+    sims, candidates = doc_similarities(mesh, vectors.vector(doc_id))
+    candidates[vectors.rows[doc_id]] = False
+    n_results = int(candidates.sum())
+    sims = np.where(candidates, sims, -np.inf)
+    doc_row = vectors.rows[doc_id]
     results = []
-    doc_conc = list(map(lambda x: x[1], mesh.graph.out_edges(doc_id)))
-    for other_doc in mesh.doc_cache.values():
-        if other_doc._.id != doc_id:
-            other_doc_conc = list(map(lambda x: x[1], mesh.graph.out_edges(other_doc._.id)))
-            inter = [conc for conc in doc_conc if conc in other_doc_conc]
-            results.append(
-                {
-                    "id": other_doc._.id,
-                    "sim": doc.similarity(other_doc),
-                    "related": inter,
-                    "title": other_doc._.title,
-                }
-            )
-    results.sort(key=lambda x: x["sim"], reverse=True)
-    return results[: min(len(results) - 1, top_n)]
+    for row in top_k(sims, min(n_results - 1, top_n)):
+        other_id = vectors.ids[row]
+        related = (
+            mesh.shared_concepts(doc_row, set(mesh.doc_concept_ids(row).tolist()))
+            if concepts
+            else []
+        )
+        results.append(
+            {
+                "id": other_id,
+                "sim": float(sims[row]),
+                "related": related,
+                "title": mesh.doc_cache[other_id]._.title,
+            }
+        )
+    return results
+
+
+def search_q(mesh, q, top_n=10, concepts=True):
+    """
+    Search for given query inside the graph.
+    With `concepts=False`, documents are only ranked by similarity (eg while concepts are being filtered).
+    """
+    potent_concepts = mesh.get_existing_doc_concepts(q) if concepts else set()
+    sims, candidates = doc_similarities(mesh, q.vector)
+    return rank_results(mesh, sims, candidates, potent_concepts, top_n, concepts)
 
 
-def search_q(mesh, q, top_n=10):
-    """Search for given query inside the graph."""
+def search_batch(mesh, queries, top_n=10, concepts=True, chunk_size=256):
+    """
+    `search_q` for a list of parsed queries, see `parse_queries`. Returns their results in order.
+    In exact search mode, the similarities of `chunk_size` queries at a time are computed with
+    a single matrix product.
+    """
+    vectors = mesh.doc_vectors
+    if not vectors.ids:  # empty knowledge base
+        return [[] for _ in queries]
     results = []
-    potent_concepts = mesh.get_existing_doc_concepts(q)
-    for doc2 in mesh.doc_cache.values():
-        doc_concepts = list(map(lambda x: x[1], mesh.graph.out_edges(doc2._.id)))
-        inter = [conc for conc in doc_concepts if conc in potent_concepts]
-        sim = doc2.similarity(q)
-        if sim:
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start : start + chunk_size]
+        if mesh.ann_index is None or mesh.conf["search"]["mode"] != "approximate":
+            q_vectors = np.stack([normalize(q.vector) for q in chunk])
+            chunk_sims = q_vectors @ vectors.matrix.T
+            scored = [(sims, vectors.alive_mask.copy()) for sims in chunk_sims]
+        else:
+            scored = [doc_similarities(mesh, q.vector) for q in chunk]
+        for q, (sims, candidates) in zip(chunk, scored):
+            potent_concepts = mesh.get_existing_doc_concepts(q) if concepts else set()
             results.append(
-                {
-                    "id": doc2._.id,
-                    "sim": q.similarity(doc2),
-                    "related": inter,
-                    "title": doc2._.title,
-                }
+                rank_results(mesh, sims, candidates, potent_concepts, top_n, concepts)
             )
-    max_inter = 1
-
-    if results:
-        # integrate number of related concepts as a factor of the score - hyperparams need tuning here
-        sim_norm = [0, 0]
-        for result in results:
-            max_inter = max(max_inter, len(result["related"]))
-            sim_norm[0] = max(sim_norm[0], result["sim"])
-            sim_norm[1] = min(sim_norm[1], result["sim"])
-        for result in results:
-            result["sim"] = (result["sim"] - sim_norm[1]) / (
-                sim_norm[0] - sim_norm[1]
-            ) * 18 + (
-                len(result["related"]) / max_inter
-            )  # normalize similarity and add interconnections
-        results.sort(key=lambda x: x["sim"], reverse=True)
-        return results[: min(len(results) - 1, top_n)]
-    return []
+    return results
+
+
+def rank_results(mesh, sims, candidates, potent_concepts, top_n=10, concepts=True):
+    """
+    Rank the candidate documents of a query by their similarity to it and by how many of the
+    query's concepts they are linked to.
+    """
+    vectors = mesh.doc_vectors
+    candidates &= sims != 0
+    n_results = int(candidates.sum())
+    if not n_results:
+        return []
+
+    # number of query concepts each doc is linked to, merged from the concepts' posting lists
+    potent_cids = {mesh.concept_cache[c] for c in potent_concepts}
+    postings = [mesh.concept_rows(concept) for concept in potent_concepts]
+    n_related = np.bincount(
+        np.concatenate(postings) if postings else np.zeros(0, dtype=np.int64),
+        minlength=len(sims),
+    ).astype(np.float64)[: len(sims)]
+    n_related[~candidates] = 0
+
+    # integrate number of related concepts as a factor of the score - hyperparams need tuning here
+    max_inter = max(1, n_related.max())
+    sim_max = max(0, sims[candidates].max())
+    sim_min = min(0, sims[candidates].min())
+    scores = (sims - sim_min) / (sim_max - sim_min) * 18 + (
+        n_related / max_inter
+    )  # normalize similarity and add interconnections
+    scores[~candidates] = -np.inf
+
+    results = []
+    for row in top_k(scores, min(n_results - 1, top_n)):
+        doc_id = vectors.ids[row]
+        results.append(
+            {
+                "id": doc_id,
+                "sim": float(scores[row]),
+                "related": mesh.shared_concepts(row, potent_cids) if concepts else [],
+                "title": mesh.doc_cache[doc_id]._.title,
+            }
+        )
+    return results
+
+
+def parse_query(nlp, text, concepts=True, disable=("lemmatizer", "textcat")):
+    """
+    Parse a search query. Matching it with concepts needs its noun chunks and entities, unless
+    the mesh has a `concept_matcher`, so the tagger, parser and NER run, without the `disable`d
+    components. Otherwise only the tokenizer runs: the query's vector comes straight from the
+    static vectors table.
+    """
+    if not concepts:
+        return nlp.make_doc(text)
+    return nlp(text, disable=[name for name in disable if name in nlp.pipe_names])
+
+
+def parse_queries(nlp, texts, concepts=True, disable=("lemmatizer", "textcat"), batch_size=64):
+    """`parse_query` for a list of texts, parsed in batches."""
+    if not concepts:
+        return list(nlp.tokenizer.pipe(texts, batch_size=batch_size))
+    disable = [name for name in disable if name in nlp.pipe_names]
+    return list(nlp.pipe(texts, disable=disable, batch_size=batch_size))
 
 
 def process_markdown(content):
@@ -138,22 +225,17 @@ def process_markdown(content):
     return content
 
 
-def load_url(url, nlp):
+def load_url(url, nlp, concepts=True, disable=("lemmatizer", "textcat"), fetcher=None):
     """
     Process url to get content for analysis. [WIP feature (see readme)]
+    See parse_query for `concepts` and `disable`, and espial/fetch.py for `fetcher`.
     """
-    try:
-        url_request = requests.get(
-            url,
-            headers={"User-agent": f"Espial/v0.1"},
-        )
-    except Exception:
+    article = (fetcher or ArticleFetcher()).fetch(url)
+    if article is None:
         return False
-    html_doc = Document(url_request.text)
-    content = html2text(html_doc.summary(), bodywidth=0)
-    doc = nlp(content)
+    doc = parse_query(nlp, article["text"], concepts, disable)
     doc._.id = url
-    doc._.title = html_doc.short_title() or url
+    doc._.title = article["title"]
     return doc
 
 
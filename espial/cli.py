@@ -1,6 +1,10 @@
+import os
 import click
 from espial.config import Config
 from espial import create_app
+from espial.load import load_mesh
+from espial.index import load_ann_index, recall_report
+from espial.serve import PreforkServer
 from pathlib import Path
 
 
@@ -10,16 +14,8 @@ def espial():
     pass
 
 
-@espial.command("run")
-@click.argument("data-dir", type=click.Path(exists=True))
-@click.option("--rerun", help="Regenerate existing concept graph", is_flag=True)
-@click.option("--port", type=int, help="Port to run server on.", default=None)
-@click.option("--host", type=str, help="Host to run server on.", default=None)
-def run(data_dir, rerun, port, host):
-    data_dir = Path(data_dir)
-    if not data_dir.exists():
-        click.echo("Data directory does not exist.")
-        return
+def load_config(data_dir):
+    """Load the user's config from `data_dir/espial.py`, if it exists."""
     config_path = data_dir / "espial.py"
     try:
         contents = open(config_path)
@@ -30,12 +26,92 @@ def run(data_dir, rerun, port, host):
     except FileNotFoundError:
         config = Config()
     config.data_dir = data_dir
+    return config
+
+
+@espial.command("run")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--rerun", help="Regenerate existing concept graph", is_flag=True)
+@click.option("--port", type=int, help="Port to run server on.", default=None)
+@click.option("--host", type=str, help="Host to run server on.", default=None)
+@click.option("--watch", help="Fold changes to your notes into the running server", is_flag=True)
+def run(data_dir, rerun, port, host, watch):
+    data_dir = Path(data_dir)
+    if not data_dir.exists():
+        click.echo("Data directory does not exist.")
+        return
+    config = load_config(data_dir)
     config.port = port or config.port
     config.host = host or config.host
     config.ANALYSIS["rerun"] = rerun
+    config.WATCH["enabled"] = watch or config.WATCH["enabled"]
     app = create_app(config)
     app.run(port=config.port, host=config.host)
 
+@espial.command("serve")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--workers", type=int, help="Number of worker processes, defaults to the number of CPUs.", default=None)
+@click.option("--rerun", help="Regenerate existing concept graph", is_flag=True)
+@click.option("--port", type=int, help="Port to run server on.", default=None)
+@click.option("--host", type=str, help="Host to run server on.", default=None)
+@click.option("--watch", help="Fold changes to your notes into the running server", is_flag=True)
+@click.option("--graceful-timeout", type=float, help="Seconds workers have to finish their requests when stopped.", default=30)
+def serve(data_dir, workers, rerun, port, host, watch, graceful_timeout):
+    """
+    Load the mesh once and serve it from several worker processes (Unix only), that share its
+    memory. Send SIGHUP to the master process to load changed notes without downtime.
+    """
+    if not hasattr(os, "fork"):
+        click.echo("espial serve needs os.fork, use espial run on this platform.")
+        return
+    config = load_config(Path(data_dir))
+    config.port = port or config.port
+    config.host = host or config.host
+    config.ANALYSIS["rerun"] = rerun
+    config.WATCH["enabled"] = watch or config.WATCH["enabled"]
+    PreforkServer(config, workers, graceful_timeout).run()
+
+
+@espial.command("ann-report")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--queries", type=int, help="Number of documents used as queries.", default=100)
+@click.option("--top-n", type=int, help="Number of results compared per query.", default=10)
+def ann_report(data_dir, queries, top_n):
+    """Measure recall and latency of approximate search to tune n_probe / n_lists."""
+    config = load_config(Path(data_dir))
+    mesh, nlp, rerun = load_mesh(config)
+    index = mesh.ann_index or load_ann_index(mesh, Path(data_dir) / ".ann_index")
+    click.echo(
+        f"{len(index)} docs in {len(index.members)} clusters, recall@{top_n} over {queries} queries"
+    )
+    click.echo(f"{'mode':<12} {'n_probe':>7} {'recall':>7} {'mean ms':>8} {'p95 ms':>8}")
+    for row in recall_report(mesh, index, queries, top_n):
+        click.echo(
+            f"{row['mode']:<12} {row['n_probe'] or '-':>7} {row['recall']:>7.3f} {row['mean_ms']:>8.2f} {row['p95_ms']:>8.2f}"
+        )
+
+
+@espial.command("check")
+@click.argument("data-dir", type=click.Path(exists=True))
+@click.option("--tolerance", type=float, help="Accepted fraction of differing concepts / links.", default=0.05)
+def check(data_dir, tolerance):
+    """Check that the incrementally updated concepts match a full rerun of the analysis."""
+    config = load_config(Path(data_dir))
+    mesh, nlp, rerun = load_mesh(config)
+    if rerun:
+        mesh.remove_irrelevant_edges()
+        mesh.trim_all()
+    report = mesh.consistency_report(tolerance)
+    click.echo(
+        f"{report['concepts']} concepts ({report['full_concepts']} with a full rerun), "
+        f"{report['concept_mismatch']:.2%} of concepts and {report['link_mismatch']:.2%} of links differ, "
+        f"score difference: mean {report['mean_score_diff']:.4f}, max {report['max_score_diff']:.4f}"
+    )
+    if not report["ok"]:
+        click.echo(f"Differences exceed the tolerance, run `espial run {data_dir} --rerun`.")
+        raise SystemExit(1)
+
+
 @espial.command("config")
 @click.argument("data-dir", type=click.Path(exists=True))
 def config(data_dir):
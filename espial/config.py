@@ -1,6 +1,7 @@
 from hashlib import sha256
 from pathlib import Path
-import re
+from espial.jobs import WriteJob, write_if_changed
+from espial.tagging import TagJob, tag_edits
 
 
 class Config(object):
@@ -10,6 +11,7 @@ class Config(object):
             "openness": 0,  # Positive values (eg -1) will lower the thresholds motif mesh uses when deciding whether to add links / ideas to the graph or not. This is better for exploration. Negative values will make it more strict (less concepts, higher quality).
             "max_concepts": 500,  # Upper bound on number of concepts saved in graph.
             "batch_size": 40,  # Processes documents by batches. If running on large documents, you may want to reduce batch size so as not to overload memory.
+            "n_process": 1,  # Number of processes used to parse new documents, -1 uses every CPU. Each process loads its own copy of the spaCy model.
             "rerun": 0,
             "cutoffs": {  # criteria used to remove a concept
                 "min_links": 2,  # min number of doc-concept links
@@ -21,18 +23,63 @@ class Config(object):
                 "min_edge_ent_tf_idf": 0.10,
                 "min_edge_noun_tf_idf": 0.01,
             },
-            "scrape_links": False,
+            "incremental": {  # on startup, only analyze the concepts of new, changed or deleted docs again
+                "enabled": True,
+                "max_idf_drift": 0.05,  # rerun the whole analysis once the number of docs changed enough to move every concept's idf by this much, see `espial check`
+            },
+            "lazy_docs": {  # only keep the vectors and metadata of docs in memory, parsed docs are read from disk when needed
+                "enabled": False,
+                "cache_size": 128,  # number of recently used parsed docs kept in memory
+            },
+            "snapshot": True,  # save the analyzed mesh to .mesh_snapshot, which is memory-mapped on the next start if no note changed (parsed docs are then loaded lazily, see lazy_docs)
+            "scrape_links": False,  # add the articles linked from notes to the mesh as "external" docs, see FETCH
+            "search": {  # document similarity search used by the search and most similar views
+                "mode": "exact",  # "exact" scores every document, "approximate" only scores the closest clusters of an index (faster on large KBs)
+                "n_lists": 0,  # number of clusters of the approximate index, 0 picks sqrt(number of docs)
+                "n_probe": 8,  # clusters scanned per query in approximate mode. Higher values are more accurate but slower, see `espial ann-report`
+            },
         }
+        self.model = "en_core_web_md"  # spaCy pipeline that parses your notes, the name of an installed package or the path of a saved pipeline
         self.port = 5002  # port to run Espial on
         self.host = "127.0.0.1"
         self.IGNORE = []  # sub-directories to ignore when crawling
+        self.QUERY = {  # how search queries and articles are parsed
+            "concepts": True,  # match them with concepts, which needs the parser and NER. Otherwise only their vector is used, which is much faster. Requests can override it with `concepts`
+            "matcher": True,  # find concepts by matching the query's tokens with the words that mention them in your notes, instead of parsing it like notes (slower, only finds the exact words)
+            "disable": ["lemmatizer", "textcat"],  # pipeline components that aren't needed to match concepts, when queries are parsed
+            "max_batch": 1000,  # most queries /batch_search accepts in one request
+        }
+        self.CACHE = {  # LRU caches of search results, hit rates are served at /cache_stats
+            "ttl": 600,  # seconds before an entry expires
+            "queries": 256,  # parsed search queries
+            "articles": 32,  # fetched and parsed articles of /article_search
+            "results": 1024,  # result lists of searches and similar docs, until the mesh changes
+        }
+        self.FETCH = {  # fetching of the pages compared to the knowledge base by /article_search
+            "timeout": [3.05, 10],  # seconds to connect and between bytes received, a page is dropped after their sum
+            "max_concurrent": 4,  # pages fetched at once
+            "pool_size": 8,  # connections kept open per host
+            "max_age": 3600,  # seconds a fetched article is used before checking whether the page changed
+            "max_bytes": 5000000,  # pages are cut after this size
+            "host_interval": 1.0,  # min seconds between two requests to the same host
+            "link_max_age": 604800,  # seconds the articles of links scraped from notes (ANALYSIS["scrape_links"]) are reused on startup
+        }
+        self.WATCH = {  # fold changed notes into the running server, see `espial run --watch`
+            "enabled": False,
+            "debounce": 1.0,  # seconds without changes before a batch of changes is applied
+            "poll_interval": 2.0,  # seconds between scans of the notes, when inotify_simple isn't installed
+        }
+        self.METRICS = {  # timings served in the Prometheus text format at /metrics
+            "profile": None,  # "cprofile", or "pyinstrument" if it is installed, to profile requests one at a time
+            "profile_min_seconds": 1.0,  # profiles of requests slower than this (or with `profile=1` in their query string) are saved to <data-dir>/.profiles
+        }
         self.ALLOWED_ORIGINS = []  # websites allowed to fetch data from Espial
 
     def get_item_id(self, item):
         """
-        Gets the id of the document. If your knowledge base has IDs you can fetch them here, otherwise Espial will compute a hash
+        Gets the id of the document. If your knowledge base has IDs you can fetch them here, otherwise Espial will use the hash of its contents
         """
-        return sha256(item["content"].encode()).hexdigest()
+        return item.get("hash") or sha256(item["content"].encode()).hexdigest()
 
     def get_title(self, path, contents):
         """
@@ -48,26 +95,52 @@ class Config(object):
         """
         Creates a tag by replacing occurences of the concept with #concept.
         """
-        for doc, concept, data in mesh.graph.in_edges(concept, data=True):
-            path = Path(mesh.graph.nodes[doc]["path"])
-            # edge['orig'] stores the words in the original text that caused the link
-            matching_occurs = [re.escape(x) for x in data["orig"]]
-            tag_re = re.compile(
-                rf"(^|\n| )({'|'.join(matching_occurs)})($|\n| )", re.IGNORECASE
-            )  # for each word that lead to the concept, replace it with #concept
-            contents = tag_re.sub(rf"\1#{concept}\3", path.open("r").read())
-            with path.open("w") as f:
-                f.write(contents)
+        self.create_tags([concept], mesh).run()
+
+    def create_tags(self, concepts, mesh, dry_run=False):
+        """
+        Prepares a TagJob creating the tags of several concepts, that rewrites each file once.
+        The words in the original text that caused each link are replaced with #concept, see espial/tagging.py.
+        """
+        return TagJob(tag_edits(mesh, concepts), dry_run)
+
+    def concept_note(self, concept, mesh, get_link=None):
+        """
+        The contents of the note of a concept, listing all the documents related to it.
+        `get_link(doc_id)` defaults to calling get_link on the doc.
+        """
+        if get_link is None:
+            get_link = lambda doc: self.get_link(mesh.doc_cache[doc])
+        lines = [f"# {concept}\n"]
+        for doc, data in mesh.concept_edges(concept):
+            lines.append(f"- {get_link(doc)}: Mentioned {data['count']} times.\n")
+        return "".join(lines)
 
     def create_concept_note(self, concept, mesh):
         """
         Creates a note listing all the documents related to a given concept.
+        The note isn't written again if it didn't change.
         """
-        contents = f"# {concept}\n"
-        for doc, concept, data in mesh.graph.in_edges(concept, data=True):
-            doc = mesh.doc_cache[doc]
-            contents += f"- {self.get_link(doc)}: Mentioned {data['count']} times.\n"
         conc_dir = Path(self.data_dir) / "concepts"
         conc_dir.mkdir(exist_ok=True)
-        with open(conc_dir / f"{concept}.md", "w") as f:
-            f.write(contents)
+        return write_if_changed(conc_dir / f"{concept}.md", self.concept_note(concept, mesh))
+
+    def create_concept_notes(self, concepts, mesh):
+        """
+        Prepares a WriteJob creating the notes of several concepts, see espial/jobs.py.
+        The notes are built right away, each doc's link is only made once.
+        """
+        links = {}
+
+        def get_link(doc):
+            if doc not in links:
+                links[doc] = self.get_link(mesh.doc_cache[doc])  # a DocRecord if docs are loaded lazily
+            return links[doc]
+
+        conc_dir = Path(self.data_dir) / "concepts"
+        conc_dir.mkdir(exist_ok=True)
+        notes = {
+            conc_dir / f"{concept}.md": self.concept_note(concept, mesh, get_link)
+            for concept in concepts
+        }
+        return WriteJob("concept_notes", notes)
@@ -1,6 +1,13 @@
-import math
+import copy
+import gzip
+import itertools
+import json
+import os
 import networkx
 import numpy as np
+from collections.abc import Sequence
+from scipy import sparse
+from espial.snapshot import docs_digest, write_snapshot
 
 
 def cos_sim(v1, v2):
@@ -12,15 +19,248 @@ def sigmoid(z):
     return 1 / (1 + np.exp(-z))
 
 
+def normalize(vector):
+    """L2-normalize a vector as float32, zero vectors stay zero."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+class DocVectors:
+    """
+    Contiguous float32 matrix of L2-normalized document vectors.
+
+    Rows are stable: removing a document zeroes its row and marks it dead instead of
+    moving other rows, so row numbers can be used to index other per-document arrays.
+    """
+
+    def __init__(self):
+        self.ids = []  # row -> doc id (None for removed docs)
+        self.rows = {}  # doc id -> row
+        self.data = np.zeros((0, 0), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, id):
+        return id in self.rows
+
+    @property
+    def matrix(self):
+        return self.data[: len(self.ids)]
+
+    @property
+    def alive_mask(self):
+        return self.alive[: len(self.ids)]
+
+    def _grow(self, dim):
+        capacity = max(16, 2 * self.data.shape[0])
+        n_rows = len(self.ids)
+        data = np.zeros((capacity, dim), dtype=np.float32)
+        if n_rows:
+            data[:n_rows] = self.data[:n_rows]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:n_rows] = self.alive[:n_rows]
+        self.data, self.alive = data, alive
+
+    def add(self, id, vector):
+        """Add or update the vector of a document and return its row."""
+        vector = normalize(vector)
+        if id in self.rows:
+            row = self.rows[id]
+        else:
+            row = len(self.ids)
+            if row >= self.data.shape[0] or self.data.shape[1] != vector.shape[0]:
+                if self.ids and self.data.shape[1] != vector.shape[0]:
+                    raise ValueError("Document vectors must all have the same size.")
+                self._grow(vector.shape[0])
+            self.ids.append(id)
+            self.rows[id] = row
+        self.data[row] = vector
+        self.alive[row] = True
+        return row
+
+    def remove(self, id):
+        row = self.rows.pop(id, None)
+        if row is None:
+            return
+        self.ids[row] = None
+        self.data[row] = 0
+        self.alive[row] = False
+
+    def vector(self, id):
+        return self.data[self.rows[id]]
+
+    def similarities(self, vector):
+        """Cosine similarity of a vector with every row (removed rows score 0)."""
+        if not self.ids:  # no width to multiply with until the first doc is added
+            return np.zeros(0, dtype=np.float32)
+        return self.matrix @ normalize(vector)
+
+
+class Column:
+    """Growable numpy array for per-row attributes that are appended one at a time."""
+
+    def __init__(self, dtype, width=None):
+        self.data = np.zeros((16,) if width is None else (16, width), dtype=dtype)
+        self.size = 0
+
+    @classmethod
+    def from_array(cls, values):
+        """Column of the rows of `values`, used in place until it grows."""
+        column = cls.__new__(cls)
+        column.data = values
+        column.size = len(values)
+        return column
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def values(self):
+        return self.data[: self.size]
+
+    def resize(self, size):
+        """Grow the column to at least `size` rows, new rows are zeroed."""
+        if size > self.data.shape[0]:
+            data = np.zeros(
+                (max(size, 2 * self.data.shape[0]),) + self.data.shape[1:],
+                dtype=self.data.dtype,
+            )
+            data[: self.size] = self.data[: self.size]
+            self.data = data
+        self.size = max(self.size, size)
+
+    def append(self, value):
+        self.resize(self.size + 1)
+        self.data[self.size - 1] = value
+
+
+class LinkOrigs(Sequence):
+    """
+    Original texts of each link, read on access from the flat arrays of a snapshot: the ids in
+    `texts` of the origs of link e are `origs[indptr[e] : indptr[e + 1]]`.
+    """
+
+    def __init__(self, indptr, origs, texts):
+        self.indptr = indptr
+        self.origs = origs
+        self.texts = texts
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, e):
+        if not 0 <= e < len(self):
+            raise IndexError(e)
+        return [self.texts[o] for o in self.origs[self.indptr[e] : self.indptr[e + 1]].tolist()]
+
+    def __iter__(self):
+        return (self[e] for e in range(len(self)))
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
 class ConceptMesh:
+    """
+    Graph of documents and the concepts they mention.
+
+    Instead of a graph library, the mesh is stored as arrays:
+    - documents are rows of `doc_vectors`, with their attributes in row-aligned lists / arrays
+    - concepts are interned to integer ids, with their attributes in id-aligned arrays
+    - every concept mention found in a document is appended to a mention log (COO triplets of
+      doc row, concept id and original text), which is the raw input of the filtering steps
+    - doc-concept links that survive filtering are a sparse CSR doc x concept matrix of mention
+      counts (`links`), with the tf-idf and original texts of each link aligned to its entries.
+
+    Concepts whose documents were added or removed since the last filtering are tracked, so that
+    `update_concepts` only filters those again. `save_state` / `load_state` persist the mention log
+    and links between runs, `save_snapshot` / `load_snapshot` the whole mesh, without its parsed
+    docs, in a file whose arrays are mapped in place.
+
+    A networkx graph is only built by `display_graph` when exporting the graph.
+    """
+
     def __init__(self, conf, doc_cache):
-        self.graph = networkx.DiGraph(openness=conf["openness"])
-        self.doc_cache = doc_cache  # cache of doc vectors
-        self.concept_cache = {}  # cache of concept vectors
+        self.doc_cache = doc_cache  # doc id -> parsed doc or DocRecord, see espial/store.py
+        self.doc_vectors = DocVectors()  # normalized doc embeddings used for similarity queries
+        self.ann_index = None  # optional approximate index over doc_vectors, see espial/index.py
+        self.doc_titles = []  # doc row -> title
+        self.doc_paths = []  # doc row -> path, or url of external docs
+        self.doc_types = []  # doc row -> "note", or "external" for articles linked from notes
+        self.doc_hashes = []  # doc row -> hash of the content
+        self.doc_tf = np.zeros(0, dtype=np.int64)  # doc row -> number of concept mentions
+
+        self.concept_cache = {}  # concepts in the mesh: text -> concept id
+        self.concept_ids = {}  # every concept ever interned: text -> concept id
+        self.concept_names = []  # concept id -> text
+        self.concept_vectors = None  # concept id -> normalized vector (Column)
+        self.concept_has_vector = Column(bool)
+        self.concept_is_ent = Column(bool)
+        self.concept_count = Column(np.int64)  # 1 + number of docs mentioning the concept
+        self.concept_score = Column(np.float64)
+        self.concept_base_score = Column(np.float64)  # score before the bonus for the number of links
+        self.concept_avg_tf_idf = Column(np.float64)
+
+        self.orig_ids = {}  # original text of a mention -> id
+        self.orig_texts = []
+        self.mention_doc = Column(np.int32)
+        self.mention_concept = Column(np.int32)
+        self.mention_orig = Column(np.int32)
+        self.mention_ent = Column(bool)
+
+        self.links = None  # filtered doc x concept CSR matrix of mention counts
+        self.links_tf_idf = None  # tf-idf of each entry of links.data
+        self.links_orig = None  # words that brought us to the concept, for each entry of links.data
+        self._links_csc = None
+        self._raw_links = None
+        self._filtered_mentions = 0  # mentions logged before the last filtering
+        self._stale = set()  # ids of concepts that lost mentions since the last filtering
+
         self.nb_docs = 0
+        self.nb_docs_filtered = 0  # nb_docs when every concept was last filtered
+        self.version = 0  # bumped whenever docs, links or scores change, for caches keyed on it
+        self.concepts_version = 0  # bumped whenever concepts or their mentions change
+        self.concept_matcher = None  # optional ConceptMatcher for queries, see espial/matcher.py
         self.dbg = ""
         self.conf = conf
-        self.sim_cache = {}  # 2D graph of sim
+
+    def _intern_concept(self, text, concept):
+        cid = self.concept_ids.get(text)
+        if cid is None:
+            cid = len(self.concept_names)
+            self.concept_ids[text] = cid
+            self.concept_names.append(text)
+            vector = normalize(concept.vector) if concept is not None else None
+            if self.concept_vectors is None and vector is not None:
+                self.concept_vectors = Column(np.float32, len(vector))
+            if self.concept_vectors is not None:
+                self.concept_vectors.resize(cid + 1)
+                if vector is not None and len(vector) == self.concept_vectors.data.shape[1]:
+                    self.concept_vectors.data[cid] = vector
+            self.concept_has_vector.append(concept is not None and concept.has_vector)
+            for column in (
+                self.concept_is_ent,
+                self.concept_count,
+                self.concept_score,
+                self.concept_base_score,
+                self.concept_avg_tf_idf,
+            ):
+                column.append(0)
+        return cid
 
     def create_link(self, item, concept, is_ent=False):
         """
@@ -47,130 +287,355 @@ class ConceptMesh:
                 return
         if len(text) < 4:
             return
-        orig_text = concept.text
-        if not text in self.concept_cache:
-            self.sim_cache[text] = {}
-            self.concept_cache[text] = concept
-            self.graph.add_node(
-                text,
-                score=0,
-                count=1,
-                is_ent=is_ent,
-                type="concept",
-                avg_tf_idf=0,
+        orig_text = concept.text  # save words that brought us to the concept
+        cid = self._intern_concept(text, concept)
+        self.concept_cache[text] = cid
+        self.concepts_version += 1
+        orig = self.orig_ids.setdefault(orig_text, len(self.orig_ids))
+        if orig == len(self.orig_texts):
+            self.orig_texts.append(orig_text)
+        self.mention_doc.append(self.doc_vectors.rows[item])
+        self.mention_concept.append(cid)
+        self.mention_orig.append(orig)
+        self.mention_ent.append(is_ent)
+        self._raw_links = None
+
+    def _group_mentions(self, selected=None):
+        """
+        Group the mentions of documents still in the mesh by (doc, concept) edge, only keeping
+        the concepts of the boolean mask `selected` if it is given.
+        Returns the edges' doc rows, concept ids and counts, the mentions sorted by edge and
+        the offset of each edge in that order.
+        """
+        docs = self.mention_doc.values
+        concepts = self.mention_concept.values
+        alive = self.doc_vectors.alive_mask[docs]
+        if selected is not None:
+            alive &= selected[concepts]
+        mentions = np.flatnonzero(alive)
+        keys = docs[mentions].astype(np.int64) * len(self.concept_names) + concepts[mentions]
+        sort = np.argsort(keys, kind="stable")
+        order, keys = mentions[sort], keys[sort]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else keys
+        counts = np.diff(np.r_[starts, len(keys)])
+        return docs[order[starts]], concepts[order[starts]], counts, order, starts
+
+    def _edge_origs(self, order, starts, counts, edges):
+        origs = self.mention_orig.values
+        return [
+            list(
+                dict.fromkeys(
+                    self.orig_texts[o] for o in origs[order[starts[e] : starts[e] + counts[e]]]
+                )
             )
-        elif is_ent:
-            self.graph.nodes[text]["is_ent"] = True
-        if self.graph.has_edge(item, text):
-            self.graph[item][text]["count"] += 1
-            self.graph[item][text]["orig"].add(
-                orig_text
-            )  # save words that brought us to the concept
-        else:
-            self.graph.add_edge(item, text, count=1, orig=set([orig_text]))
-            self.graph.nodes[text]["count"] += 1
-        self.graph.nodes[item]["tf"] += 1
+            for e in edges
+        ]
+
+    def _set_links(self, rows, cids, counts, tf_idf, origs):
+        """Replace the links with the given edges, which must be sorted by (row, concept id)."""
+        n_rows = len(self.doc_vectors.ids)
+        indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_rows))]
+        self.links = sparse.csr_matrix(
+            (np.asarray(counts, dtype=np.int64), np.asarray(cids, dtype=np.int32), indptr),
+            shape=(n_rows, len(self.concept_names)),
+        )
+        self.links_tf_idf = np.asarray(tf_idf, dtype=np.float64)
+        self.links_orig = origs
+        self._links_csc = None
 
-    def remove_irrelevant_edges(self):
+    def _keep_links(self, keep):
+        """Only keep the entries of `links` selected by the boolean mask `keep`."""
+        coo_rows = np.repeat(np.arange(self.links.shape[0]), np.diff(self.links.indptr))
+        self._set_links(
+            coo_rows[keep],
+            self.links.indices[keep],
+            self.links.data[keep],
+            self.links_tf_idf[keep],
+            [orig for orig, k in zip(self.links_orig, keep) if k],
+        )
+
+    def _edges(self):
+        """Current links, or all raw mention edges if the mesh hasn't been filtered yet."""
+        if self.links is not None:
+            return self.links
+        if self._raw_links is None:
+            rows, cids, counts, _, _ = self._group_mentions()
+            n_rows = len(self.doc_vectors.ids)
+            self._raw_links = sparse.csr_matrix(
+                (counts, (rows, cids)), shape=(n_rows, len(self.concept_names))
+            )
+        return self._raw_links
+
+    def remove_irrelevant_edges(self, selected=None):
         """
         Step 1 of the process described in ARCHITECTURE.md - statistical filtering.
+
+        If `selected` (a boolean mask of concept ids) is given, only the links of these concepts
+        are filtered again, the links of other concepts are kept as they are.
         """
-        for item, concept, data in list(self.graph.edges(data=True)):
-            if concept in self.graph:
-                tf = data["count"] / self.graph.nodes[item]["tf"]
-                idf = math.log(self.nb_docs / self.graph.nodes[concept]["count"])
-                tf_idf = tf * idf
-                is_ent = self.graph.nodes[concept]["is_ent"]
-                remove_crit = (
-                    tf_idf
-                    < self.conf["cutoffs"]["min_edge_noun_tf_idf"]
-                    and not is_ent
-                ) or (tf_idf < self.conf["cutoffs"]["min_edge_ent_tf_idf"] and is_ent)
-                has_vector = self.concept_cache[concept].has_vector
-                if not remove_crit and has_vector:
-                    sim = self.doc_cache[item].similarity(
-                        self.concept_cache[concept]
-                    )  # save embedding
-                if remove_crit or (has_vector and sim < 0.3):
-                    self.graph.remove_edge(item, concept)
-                else:
-                    if has_vector:
-                        self.sim_cache[concept][item] = sim
-                    self.graph[item][concept]["tf_idf"] = tf_idf
-                    self.graph.nodes[concept]["avg_tf_idf"] += tf_idf
-        for concept in list(self.concept_cache.keys()):
-            if (
-                len(list(self.graph.in_edges(concept)))
-                < self.conf["cutoffs"]["min_links"]
-            ):
-                self.graph.remove_node(concept)
-                self.concept_cache.pop(concept)
+        self.version += 1
+        self.concepts_version += 1
+        n_concepts = len(self.concept_names)
+        if selected is None or self.links is None:
+            selected = np.ones(n_concepts, dtype=bool)
+        rows, cids, counts, order, starts = self._group_mentions(selected)
+        alive_mentions = self.doc_vectors.alive_mask[self.mention_doc.values]
+        self.doc_tf = np.bincount(
+            self.mention_doc.values[alive_mentions], minlength=len(self.doc_vectors.ids)
+        )
+        self.concept_count.values[selected] = (
+            1 + np.bincount(cids, minlength=n_concepts)[selected]
+        )
+        self.concept_is_ent.values[selected] = (
+            np.bincount(
+                self.mention_concept.values[alive_mentions],
+                weights=self.mention_ent.values[alive_mentions],
+                minlength=n_concepts,
+            )[selected]
+            > 0
+        )
+
+        tf = counts / self.doc_tf[rows]
+        idf = np.log(self.nb_docs / self.concept_count.values[cids])
+        tf_idf = tf * idf
+        is_ent = self.concept_is_ent.values[cids]
+        cutoffs = self.conf["cutoffs"]
+        remove_crit = ((tf_idf < cutoffs["min_edge_noun_tf_idf"]) & ~is_ent) | (
+            (tf_idf < cutoffs["min_edge_ent_tf_idf"]) & is_ent
+        )
+        check_sim = np.flatnonzero(~remove_crit & self.concept_has_vector.values[cids])
+        for i in range(0, len(check_sim), 16384):  # doc-concept similarity, in chunks
+            chunk = check_sim[i : i + 16384]
+            sims = np.einsum(
+                "ij,ij->i",
+                self.doc_vectors.matrix[rows[chunk]],
+                self.concept_vectors.values[cids[chunk]],
+            )
+            remove_crit[chunk[sims < 0.3]] = True
+        kept = np.flatnonzero(~remove_crit)
+
+        n_links = np.bincount(cids[kept], minlength=n_concepts)
+        sum_tf_idf = np.bincount(cids[kept], weights=tf_idf[kept], minlength=n_concepts)
+        for cid in np.flatnonzero(selected):
+            concept = self.concept_names[cid]
+            if n_links[cid] < cutoffs["min_links"]:
+                self.concept_cache.pop(concept, None)
             else:
-                self.graph.nodes[concept]["avg_tf_idf"] /= len(
-                    list(self.graph.in_edges(concept))
-                )
-        # for item, concept in self.graph.edges:
-        #    self.dbg += f"EDGE {self.doc_cache[item]._.title} {item} {concept}\n"
+                self.concept_cache[concept] = cid
+                self.concept_avg_tf_idf.data[cid] = sum_tf_idf[cid] / n_links[cid]
+        in_mesh = np.zeros(n_concepts, dtype=bool)
+        in_mesh[list(self.concept_cache.values())] = True
+        kept = kept[in_mesh[cids[kept]]]
+        origs = self._edge_origs(order, starts, counts, kept)
+        rows, cids, counts, tf_idf = rows[kept], cids[kept], counts[kept], tf_idf[kept]
+        if not selected.all():  # merge with the links of the other concepts
+            keep = ~selected[self.links.indices]
+            old_rows = np.repeat(np.arange(self.links.shape[0]), np.diff(self.links.indptr))
+            rows = np.r_[old_rows[keep], rows]
+            cids = np.r_[self.links.indices[keep], cids]
+            counts = np.r_[self.links.data[keep], counts]
+            tf_idf = np.r_[self.links_tf_idf[keep], tf_idf]
+            origs = [orig for orig, k in zip(self.links_orig, keep) if k] + origs
+            sort = np.lexsort((cids, rows))
+            rows, cids, counts, tf_idf = rows[sort], cids[sort], counts[sort], tf_idf[sort]
+            origs = [origs[e] for e in sort]
+        else:
+            self.nb_docs_filtered = self.nb_docs
+        self._set_links(rows, cids, counts, tf_idf, origs)
+        self._filtered_mentions = len(self.mention_doc)
+        self._stale = set()
 
-    def trim_concept(self, concept):
-        """Step 2 of ARCHITECTURE.md"""
-        avg = 0
-        is_ent = self.graph.nodes[concept]["is_ent"]
-        linked_docs = list(self.graph.in_edges(concept))
-        word_sim = 0
-        has_vector = self.concept_cache[concept].has_vector
-        for link in linked_docs:
-            doc1 = link[0]  # id of first doc
-            if has_vector:
-                if not doc1 in self.sim_cache[concept]:
-                    self.sim_cache[concept][doc1] = self.doc_cache[doc1].similarity(
-                        self.concept_cache[concept]
-                    )
-                word_sim += self.sim_cache[concept][doc1]
-            for link2 in linked_docs:
-                doc2 = link2[0]
-                if doc1 != doc2:
-                    if not doc2 in self.sim_cache[doc1]:
-                        curr_sim = self.compute_similarity(doc1, doc2)
-                        self.sim_cache[doc1][doc2] = curr_sim
-                        self.sim_cache[doc2][doc1] = curr_sim
-                    avg += self.sim_cache[doc1][doc2]
-        total_in_edges = len(linked_docs)
-        avg = avg / (total_in_edges * (total_in_edges - 1) / 2)
-        word_sim /= total_in_edges
-        if not has_vector:
-            word_sim = 1
-        avg_tf_idf = self.graph.nodes[concept]["avg_tf_idf"]
+    def concept_coherence(self, cids):
+        """
+        Average pairwise similarity of the docs linked to each concept, and their average similarity
+        to the concept itself.
+
+        Both come from the sum S of the normalized doc vectors: the sum of the similarities of every
+        ordered pair of distinct docs is |S|^2 minus the squared norms of the vectors themselves,
+        and the sum of the docs' similarities to the concept is S . concept.
+        """
+        links = self._concept_links()[:, cids]
+        links.data = np.ones_like(links.data, dtype=np.float64)
+        vectors = self.doc_vectors.matrix[: links.shape[0]]
+        vec_sums = np.asarray(links.T @ vectors)
+        n_docs = np.diff(links.indptr)
+        self_sims = links.T @ vectors.any(axis=1)  # zero vectors have 0 similarity
+        n_pairs = np.maximum(n_docs * (n_docs - 1) / 2, 1)
+        avg = np.where(
+            n_docs > 1, (np.einsum("ij,ij->i", vec_sums, vec_sums) - self_sims) / n_pairs, 0
+        )
+        word_sim = np.ones(len(cids))
+        if self.concept_vectors is not None:
+            has_vector = self.concept_has_vector.values[cids]
+            word_sims = np.einsum("ij,ij->i", vec_sums, self.concept_vectors.values[cids])
+            word_sim[has_vector] = word_sims[has_vector] / np.maximum(n_docs[has_vector], 1)
+        return avg, word_sim, n_docs
+
+    def _trim(self, concepts):
+        """Step 2 of ARCHITECTURE.md, for a batch of concepts. Returns their number of links."""
+        self.version += 1
+        cids = np.array([self.concept_cache[c] for c in concepts], dtype=np.int64)
+        avg, word_sim, n_docs = self.concept_coherence(cids)
+        is_ent = self.concept_is_ent.values[cids]
+        avg_tf_idf = self.concept_avg_tf_idf.values[cids]
         cutoffs = self.conf["cutoffs"]
-        ent_criteria = (
-            avg < cutoffs["min_avg_children_sim"]
-            or word_sim < cutoffs["min_avg_ent_sim"]
-            and avg_tf_idf < cutoffs["min_avg_ent_tf_idf"]
+        ent_criteria = (avg < cutoffs["min_avg_children_sim"]) | (
+            (word_sim < cutoffs["min_avg_ent_sim"])
+            & (avg_tf_idf < cutoffs["min_avg_ent_tf_idf"])
         )
         word_crit = (
-            avg < cutoffs["min_avg_children_sim"]
-            or word_sim < cutoffs["min_avg_noun_sim"]
-            or avg_tf_idf < cutoffs["min_avg_noun_tf_idf"]
+            (avg < cutoffs["min_avg_children_sim"])
+            | (word_sim < cutoffs["min_avg_noun_sim"])
+            | (avg_tf_idf < cutoffs["min_avg_noun_tf_idf"])
         )
-        # self.dbg += f"TRIMMING {total_in_edges} {avg} {word_sim} {concept}\n"
-        if (word_crit and not is_ent) or (ent_criteria and is_ent):
-            self.graph.remove_node(concept)
+        remove = np.where(is_ent, ent_criteria, word_crit)
+        self.concept_base_score.data[cids] = (
+            np.minimum(avg, 0.85) * 2 + word_sim + np.minimum(avg_tf_idf, 0.5) * 2
+        )  # scoring needs to be fine-tuned, irrelevant for now
+        self.concept_score.data[cids] = self.concept_base_score.data[cids]
+        for concept in np.array(concepts, dtype=object)[remove]:
             self.concept_cache.pop(concept)
-        else:
-            score = (
-                min(avg, 0.85) * 2 + word_sim + min(avg_tf_idf, 0.5) * 2
-            )  # scoring needs to be fine-tuned, irrelevant for now
-            self.graph.nodes[concept]["score"] = score
+            self.concepts_version += 1
+        if remove.any():
+            self._keep_links(np.isin(self.links.indices, cids[remove], invert=True))
+        return np.where(remove, 0, n_docs)
+
+    def trim_concept(self, concept):
+        """Step 2 of ARCHITECTURE.md"""
+        self._trim([concept])
 
     def trim_all(self):
-        max_links = 0
-        for concept in list(self.concept_cache.keys()):
-            if concept in self.graph:
-                self.trim_concept(concept)
-                max_links = max(max_links, len(list(self.graph.in_edges(concept))) - 2)
-        for concept in list(self.concept_cache.keys()):
-            no_links_factor = (len(self.graph.in_edges(concept)) - 2) / max_links
-            self.graph.nodes[concept]["score"] += no_links_factor * 1.5
+        concepts = list(self.concept_cache.keys())
+        if not concepts:
+            return
+        self._trim(concepts)
+        self._add_link_bonus()
+
+    def _add_link_bonus(self):
+        """Add a bonus for their number of links to the scores of the concepts in the mesh."""
+        self.version += 1
+        cids = np.array(list(self.concept_cache.values()), dtype=np.int64)
+        if not len(cids):
+            return
+        n_links = np.diff(self._concept_links().indptr)[cids]
+        max_links = max(0, n_links.max() - 2)
+        self.concept_score.data[cids] = self.concept_base_score.data[cids]
+        if max_links:
+            self.concept_score.data[cids] += (n_links - 2) / max_links * 1.5
+
+    def update_concepts(self, max_idf_drift=0.05):
+        """
+        Steps 1 and 2 of ARCHITECTURE.md for the concepts mentioned by documents added or removed
+        since the last filtering, the links and scores of other concepts are kept.
+
+        Every idf depends on the number of documents, so the kept links slowly drift from what a
+        full rerun would give: once log(nb_docs) moved by more than `max_idf_drift` since every
+        concept was last filtered, all of them are filtered again.
+        Returns the number of concepts that were filtered.
+        """
+        n_concepts = len(self.concept_names)
+        if self.needs_full_update(max_idf_drift):
+            self.remove_irrelevant_edges()
+            self.trim_all()
+            return n_concepts
+        selected = np.zeros(n_concepts, dtype=bool)
+        selected[list(self._stale)] = True
+        selected[self.mention_concept.values[self._filtered_mentions :]] = True
+        if not selected.any():
+            return 0
+        self.remove_irrelevant_edges(selected)
+        concepts = [self.concept_names[cid] for cid in np.flatnonzero(selected)]
+        concepts = [c for c in concepts if c in self.concept_cache]
+        if concepts:
+            self._trim(concepts)
+        self._add_link_bonus()
+        return int(selected.sum())
+
+    def needs_full_update(self, max_idf_drift=0.05):
+        """Whether `update_concepts` would filter every concept again, see its docstring."""
+        drift = abs(np.log(max(self.nb_docs, 1) / max(self.nb_docs_filtered, 1)))
+        return self.links is None or drift > max_idf_drift
+
+    def refiltered(self):
+        """
+        Copy of the mesh with every concept filtered again (steps 1 and 2 of ARCHITECTURE.md).
+        The copy shares the documents and mention log of the mesh, which must not change until
+        it is done, but not the attributes that filtering writes, so the mesh can be read
+        meanwhile. `adopt_filtering` then puts the results in the mesh.
+        """
+        full = copy.copy(self)
+        for name in (
+            "concept_is_ent",
+            "concept_count",
+            "concept_score",
+            "concept_base_score",
+            "concept_avg_tf_idf",
+        ):
+            setattr(full, name, copy.deepcopy(getattr(self, name)))
+        full.concept_cache = {}
+        full._stale = set()
+        full.links = None
+        full._links_csc = None
+        full.remove_irrelevant_edges()
+        full.trim_all()
+        return full
+
+    def adopt_filtering(self, filtered):
+        """Take the concepts, links and scores of a copy of the mesh made by `refiltered`."""
+        self.version += 1
+        self.concepts_version += 1
+        for name in (
+            "concept_cache",
+            "concept_is_ent",
+            "concept_count",
+            "concept_score",
+            "concept_base_score",
+            "concept_avg_tf_idf",
+            "doc_tf",
+            "links",
+            "links_tf_idf",
+            "links_orig",
+            "_links_csc",
+            "_filtered_mentions",
+            "_stale",
+            "nb_docs_filtered",
+        ):
+            setattr(self, name, getattr(filtered, name))
+
+    def consistency_report(self, tolerance=0.05):
+        """
+        Compare the concepts, links and scores of the mesh, which may have been updated with
+        `update_concepts`, to a full rerun of steps 1 and 2 over the same documents.
+        The result is ok if the fractions of concepts and links that differ and the mean score
+        difference of the concepts in both are within `tolerance`.
+        """
+        full = self.refiltered()
+
+        def edge_set(mesh):
+            links = mesh._edges()
+            rows = np.repeat(np.arange(links.shape[0]), np.diff(links.indptr))
+            return set(zip(rows.tolist(), links.indices.tolist()))
+
+        def mismatch(a, b):
+            return 1 - len(a & b) / len(a | b) if a | b else 0.0
+
+        concepts, full_concepts = set(self.concept_cache), set(full.concept_cache)
+        cids = np.array([self.concept_cache[c] for c in concepts & full_concepts], dtype=np.int64)
+        score_diff = np.abs(self.concept_score.data[cids] - full.concept_score.data[cids])
+        report = {
+            "concepts": len(concepts),
+            "full_concepts": len(full_concepts),
+            "concept_mismatch": mismatch(concepts, full_concepts),
+            "link_mismatch": mismatch(edge_set(self), edge_set(full)),
+            "mean_score_diff": float(score_diff.mean()) if len(cids) else 0.0,
+            "max_score_diff": float(score_diff.max()) if len(cids) else 0.0,
+        }
+        report["ok"] = (
+            report["concept_mismatch"] <= tolerance
+            and report["link_mismatch"] <= tolerance
+            and report["mean_score_diff"] <= tolerance
+        )
+        return report
 
     def process_entities(self, doc):
         """Get Named Entities from doc"""
@@ -203,20 +668,38 @@ class ConceptMesh:
 
     def process_document(self, doc, index_concepts=True):
         """Save document into the mesh"""
-        self.sim_cache[doc._.id] = {}
         self.nb_docs += 1
-        self.graph.add_node(
-            doc._.id, title=doc._.title, tf=0, path=doc._.path, type="doc"
-        )
+        self.version += 1
         self.doc_cache[doc._.id] = doc
+        row = self.doc_vectors.add(doc._.id, doc.vector)
+        if row == len(self.doc_titles):
+            self.doc_titles.append(doc._.title)
+            self.doc_paths.append(doc._.path)
+            self.doc_types.append(doc._.doc_type)
+            self.doc_hashes.append(doc._.hash)
+        else:
+            self.doc_titles[row], self.doc_paths[row] = doc._.title, doc._.path
+            self.doc_types[row] = doc._.doc_type
+            self.doc_hashes[row] = doc._.hash
+        if self.ann_index is not None:
+            self.ann_index.add(doc._.id, doc.vector, doc._.hash)
         if index_concepts:
-            for ent in self.process_entities(doc):
-                self.create_link(doc._.id, ent, is_ent=True)
-            for concept in self.process_nouns(doc):
-                self.create_link(doc._.id, [concept])
+            self.index_doc_concepts(doc)
+
+    def index_doc_concepts(self, doc):
+        """Link a document of the mesh to the entities and nouns it mentions"""
+        for ent in self.process_entities(doc):
+            self.create_link(doc._.id, ent, is_ent=True)
+        for concept in self.process_nouns(doc):
+            self.create_link(doc._.id, [concept])
 
     def get_existing_doc_concepts(self, doc):
-        """Get concepts that exist in the mesh, from a document, without integrating them"""
+        """
+        Get concepts that exist in the mesh, from a document, without integrating them.
+        With a `concept_matcher`, the doc only needs to be tokenized.
+        """
+        if self.concept_matcher is not None:
+            return self.concept_matcher(doc)
         concepts = [
             c.text
             for c in self.process_nouns(doc) + self.process_entities(doc)
@@ -225,26 +708,509 @@ class ConceptMesh:
         return set(concepts)
 
     def compute_similarity(self, doc1, doc2):
-        return self.doc_cache[doc1].similarity(self.doc_cache[doc2])
+        return float(self.doc_vectors.vector(doc1) @ self.doc_vectors.vector(doc2))
 
     def remove_doc(self, id):
         self.nb_docs -= 1
-        for doc, concept in self.graph.out_edges(id):
-            self.graph.nodes[concept]["count"] -= 1
-        self.graph.remove_node(id)
+        self.version += 1
+        row = self.doc_vectors.rows[id]
+        self.doc_vectors.remove(id)
+        self.doc_cache.pop(id, None)
+        self._stale.update(
+            np.unique(self.mention_concept.values[self.mention_doc.values == row]).tolist()
+        )
+        if self.ann_index is not None:
+            self.ann_index.remove(id)
+        if self.links is not None:
+            entries = np.arange(self.links.indptr[row], self.links.indptr[row + 1])
+            keep = np.ones(self.links.nnz, dtype=bool)
+            keep[entries] = False
+            self._keep_links(keep)
+        self._raw_links = None
 
-    def display_graph(self, max_conc=None):
+    def _concept_links(self):
+        """
+        Links as a CSC matrix, to look up the documents of a concept. Its data holds, for
+        each entry, 1 + the index of the same entry in the CSR data.
+        """
+        edges = self._edges()
+        if self._links_csc is None or self._links_csc[0] is not edges:
+            entries = sparse.csr_matrix(
+                (np.arange(1, edges.nnz + 1), edges.indices, edges.indptr), shape=edges.shape
+            )
+            self._links_csc = (edges, entries.tocsc())
+        return self._links_csc[1]
+
+    def has_doc(self, id):
+        return id in self.doc_vectors
+
+    def doc_concept_ids(self, row):
+        """Ids of the concepts linked to a document row, in the order of its links."""
+        links = self._edges()
+        if row >= links.shape[0]:  # added after the links were computed
+            return links.indices[:0]
+        return links.indices[links.indptr[row] : links.indptr[row + 1]]
+
+    def doc_concepts(self, id):
+        """Concepts linked to a document."""
+        return [
+            self.concept_names[cid]
+            for cid in self.doc_concept_ids(self.doc_vectors.rows[id])
+        ]
+
+    def shared_concepts(self, row, cids):
+        """Concepts linked to a document row whose ids are in the set `cids`, in the order of its links."""
+        return [
+            self.concept_names[cid] for cid in self.doc_concept_ids(row).tolist() if cid in cids
+        ]
+
+    def concept_rows(self, concept):
+        """doc_vectors rows of the documents linked to a concept."""
+        cid = self.concept_cache[concept]
+        links = self._concept_links()
+        if cid >= links.shape[1]:
+            return links.indices[:0]
+        return links.indices[links.indptr[cid] : links.indptr[cid + 1]]
+
+    def concept_docs(self, concept):
+        """Documents linked to a concept."""
+        return [self.doc_vectors.ids[row] for row in self.concept_rows(concept)]
+
+    def concept_edges(self, concept):
+        """(doc id, link attributes) of every link of a concept."""
+        cid = self.concept_cache[concept]
+        edges = self._edges()
+        links = self._concept_links()
+        if cid >= links.shape[1]:
+            return []
+        span = slice(links.indptr[cid], links.indptr[cid + 1])
+        result = []
+        for row, e in zip(links.indices[span], links.data[span] - 1):
+            data = {"count": int(edges.data[e])}
+            if self.links is not None:
+                data["orig"] = self.links_orig[e]
+                data["tf_idf"] = float(self.links_tf_idf[e])
+            result.append((self.doc_vectors.ids[row], data))
+        return result
+
+    def doc_info(self, id):
+        row = self.doc_vectors.rows[id]
+        return {
+            "title": self.doc_titles[row],
+            "path": self.doc_paths[row],
+            "doc_type": self.doc_types[row],
+            "tf": int(self.doc_tf[row]) if row < len(self.doc_tf) else 0,
+        }
+
+    def concept_info(self, concept):
+        cid = self.concept_cache[concept]
+        return {
+            "score": float(self.concept_score.data[cid]),
+            "count": int(self.concept_count.data[cid]),
+            "is_ent": bool(self.concept_is_ent.data[cid]),
+            "avg_tf_idf": float(self.concept_avg_tf_idf.data[cid]),
+        }
+
+    def number_of_edges(self):
+        return self._edges().nnz
+
+    def number_of_nodes(self):
+        return len(self.doc_vectors) + len(self.concept_cache)
+
+    def load_graph(self, graph):
+        """Restore concepts and links from a graph previously exported by display_graph."""
+        self.version += 1
+        self.concepts_version += 1
+        rows, cids, counts, tf_idf, origs = [], [], [], [], []
+        self.doc_tf = np.zeros(len(self.doc_vectors.ids), dtype=np.int64)
+        for node, data in graph.nodes(data=True):
+            if data["type"] == "concept":
+                cid = self._intern_concept(node, None)
+                self.concept_cache[node] = cid
+                self.concept_is_ent.data[cid] = data["is_ent"]
+                self.concept_count.data[cid] = data["count"]
+                self.concept_score.data[cid] = data["score"]
+                self.concept_avg_tf_idf.data[cid] = data["avg_tf_idf"]
+            elif node in self.doc_vectors:
+                self.doc_tf[self.doc_vectors.rows[node]] = data["tf"]
+        for doc, concept, data in graph.edges(data=True):
+            if doc in self.doc_vectors and concept in self.concept_cache:
+                rows.append(self.doc_vectors.rows[doc])
+                cids.append(self.concept_cache[concept])
+                counts.append(data["count"])
+                tf_idf.append(data.get("tf_idf", 0))
+                origs.append(list(data["orig"]))
+        order = np.lexsort((cids, rows)) if rows else np.zeros(0, dtype=np.int64)
+        self._set_links(
+            np.array(rows, dtype=np.int64)[order],
+            np.array(cids, dtype=np.int64)[order],
+            np.array(counts)[order],
+            np.array(tf_idf)[order],
+            [origs[e] for e in order],
+        )
+
+    def save_state(self, path):
+        """
+        Save the mention log and filtered links of the documents in the mesh, so that the next run
+        can restore them with `load_state` instead of extracting and filtering every concept again.
+        Removed documents, and the concepts and original texts only they mentioned, are left out.
+        """
+        alive = self.doc_vectors.alive_mask
+        doc_rows = np.flatnonzero(alive)
+        row_map = np.full(len(alive), -1, dtype=np.int64)
+        row_map[doc_rows] = np.arange(len(doc_rows))
+        mentions = np.flatnonzero(alive[self.mention_doc.values])
+        used = np.zeros(len(self.concept_names), dtype=bool)
+        used[self.mention_concept.values[mentions]] = True
+        cid_map = np.cumsum(used) - 1
+        cids = np.flatnonzero(used)
+        used_origs = np.zeros(len(self.orig_texts), dtype=bool)
+        used_origs[self.mention_orig.values[mentions]] = True
+        orig_map = np.cumsum(used_origs) - 1
+
+        doc_tf = np.zeros(len(alive), dtype=np.int64)
+        doc_tf[: len(self.doc_tf)] = self.doc_tf
+        links = self.links
+        link_rows = np.repeat(np.arange(links.shape[0]), np.diff(links.indptr))
+        link_origs = [[self.orig_ids[text] for text in orig] for orig in self.links_orig]
+        arrays = {
+            "cutoffs": np.array(json.dumps(self.conf["cutoffs"], sort_keys=True)),
+            "nb_docs_filtered": np.array(self.nb_docs_filtered),
+            "doc_ids": np.array([str(self.doc_vectors.ids[row]) for row in doc_rows], dtype=str),
+            "doc_hashes": np.array([str(self.doc_hashes[row]) for row in doc_rows], dtype=str),
+            "doc_tf": doc_tf[doc_rows],
+            "concept_names": np.array([self.concept_names[cid] for cid in cids], dtype=str),
+            "concept_cache": cid_map[list(self.concept_cache.values())],
+            "concept_has_vector": self.concept_has_vector.values[cids],
+            "concept_is_ent": self.concept_is_ent.values[cids],
+            "concept_count": self.concept_count.values[cids],
+            "concept_score": self.concept_score.values[cids],
+            "concept_base_score": self.concept_base_score.values[cids],
+            "concept_avg_tf_idf": self.concept_avg_tf_idf.values[cids],
+            "orig_texts": np.array(
+                [text for text, used in zip(self.orig_texts, used_origs) if used], dtype=str
+            ),
+            "mention_doc": row_map[self.mention_doc.values[mentions]],
+            "mention_concept": cid_map[self.mention_concept.values[mentions]],
+            "mention_orig": orig_map[self.mention_orig.values[mentions]],
+            "mention_ent": self.mention_ent.values[mentions],
+            "link_rows": row_map[link_rows],
+            "link_concepts": cid_map[links.indices],
+            "link_counts": links.data,
+            "link_tf_idf": self.links_tf_idf,
+            "link_orig_counts": np.array([len(orig) for orig in link_origs], dtype=np.int64),
+            "link_origs": orig_map[
+                np.array([o for orig in link_origs for o in orig], dtype=np.int64)
+            ],
+        }
+        if self.concept_vectors is not None:
+            arrays["concept_vectors"] = self.concept_vectors.values[cids]
+        tmp_path = path.with_suffix(".tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def load_state(self, path):
+        """
+        Restore the concepts, mentions and links saved by `save_state` into a mesh whose documents
+        were added with `process_document(doc, index_concepts=False)`.
+
+        Saved documents that are no longer in the mesh, or whose hash changed, are dropped and
+        their concepts will be filtered again by `update_concepts`. Returns the ids of the
+        documents of the mesh that have no saved mentions, which must be indexed with
+        `index_doc_concepts`. Raises ValueError if the state was saved with other cutoffs.
+        """
+        self.version += 1
+        self.concepts_version += 1
+        with np.load(path) as f:
+            saved = dict(f)
+        if str(saved["cutoffs"]) != json.dumps(self.conf["cutoffs"], sort_keys=True):
+            raise ValueError("The saved concepts were filtered with different cutoffs.")
+        if self.concept_names:
+            raise ValueError("The state must be loaded before any concept is added.")
+
+        rows = self.doc_vectors.rows
+        row_map = np.array(
+            [
+                rows[id] if id in rows and self.doc_hashes[rows[id]] == hash else -1
+                for id, hash in zip(saved["doc_ids"].tolist(), saved["doc_hashes"].tolist())
+            ],
+            dtype=np.int64,
+        )
+        restored = {self.doc_vectors.ids[row] for row in row_map[row_map >= 0]}
+
+        names = saved["concept_names"].tolist()
+        self.concept_names = names
+        self.concept_ids = {name: cid for cid, name in enumerate(names)}
+        columns = {
+            "concept_has_vector": self.concept_has_vector,
+            "concept_is_ent": self.concept_is_ent,
+            "concept_count": self.concept_count,
+            "concept_score": self.concept_score,
+            "concept_base_score": self.concept_base_score,
+            "concept_avg_tf_idf": self.concept_avg_tf_idf,
+        }
+        if "concept_vectors" in saved:
+            self.concept_vectors = Column(np.float32, saved["concept_vectors"].shape[1])
+            columns["concept_vectors"] = self.concept_vectors
+        for name, column in columns.items():
+            column.resize(len(names))
+            column.values[:] = saved[name]
+        self.concept_cache = {names[cid]: int(cid) for cid in saved["concept_cache"]}
+        self.orig_texts = saved["orig_texts"].tolist()
+        self.orig_ids = {text: i for i, text in enumerate(self.orig_texts)}
+
+        mention_rows = row_map[saved["mention_doc"]]
+        kept = mention_rows >= 0
+        self._stale = set(np.unique(saved["mention_concept"][~kept]).tolist())
+        for name, values in (
+            ("mention_doc", mention_rows),
+            ("mention_concept", saved["mention_concept"]),
+            ("mention_orig", saved["mention_orig"]),
+            ("mention_ent", saved["mention_ent"]),
+        ):
+            column = getattr(self, name)
+            column.resize(int(kept.sum()))
+            column.values[:] = values[kept]
+        self._filtered_mentions = len(self.mention_doc)
+
+        self.doc_tf = np.zeros(len(self.doc_vectors.ids), dtype=np.int64)
+        self.doc_tf[row_map[row_map >= 0]] = saved["doc_tf"][row_map >= 0]
+        link_rows = row_map[saved["link_rows"]]
+        ends = np.cumsum(saved["link_orig_counts"])
+        origs = [
+            [self.orig_texts[o] for o in saved["link_origs"][end - n : end]]
+            for n, end in zip(saved["link_orig_counts"].tolist(), ends.tolist())
+        ]
+        kept = np.flatnonzero(link_rows >= 0)
+        kept = kept[np.lexsort((saved["link_concepts"][kept], link_rows[kept]))]
+        self._set_links(
+            link_rows[kept],
+            saved["link_concepts"][kept],
+            saved["link_counts"][kept],
+            saved["link_tf_idf"][kept],
+            [origs[e] for e in kept],
+        )
+        self.nb_docs_filtered = int(saved["nb_docs_filtered"])
+        return [id for id in self.doc_vectors.rows if id not in restored]
+
+    def save_snapshot(self, path, meta=None):
+        """
+        Save the filtered mesh to a snapshot (see espial/snapshot.py) that `load_snapshot` maps
+        back: doc vectors, metadata and tf, concepts and their attributes, the mention log, and
+        the links as CSR arrays. Removed documents are left out. `meta` is saved with the
+        cutoffs, openness and a digest of the documents, to check that the snapshot is current.
+        """
+        if self.links is None:
+            raise ValueError("Only filtered meshes can be saved to a snapshot.")
+        alive = self.doc_vectors.alive_mask
+        doc_rows = np.flatnonzero(alive)
+        row_map = np.full(len(alive), -1, dtype=np.int32)
+        row_map[doc_rows] = np.arange(len(doc_rows))
+        mentions = np.flatnonzero(alive[self.mention_doc.values])
+        doc_tf = np.zeros(len(alive), dtype=np.int64)
+        doc_tf[: len(self.doc_tf)] = self.doc_tf
+        links = self.links
+        n_links = np.zeros(len(alive), dtype=np.int64)  # removed docs have no links left
+        n_links[: links.shape[0]] = np.diff(links.indptr)
+        link_origs = [[self.orig_ids[text] for text in orig] for orig in self.links_orig]
+        arrays = {
+            "doc_vectors": self.doc_vectors.matrix[doc_rows],
+            "doc_tf": doc_tf[doc_rows],
+            "concept_cache": np.array(list(self.concept_cache.values()), dtype=np.int64),
+            "concept_has_vector": self.concept_has_vector.values,
+            "concept_is_ent": self.concept_is_ent.values,
+            "concept_count": self.concept_count.values,
+            "concept_score": self.concept_score.values,
+            "concept_base_score": self.concept_base_score.values,
+            "concept_avg_tf_idf": self.concept_avg_tf_idf.values,
+            "mention_doc": row_map[self.mention_doc.values[mentions]],
+            "mention_concept": self.mention_concept.values[mentions],
+            "mention_orig": self.mention_orig.values[mentions],
+            "mention_ent": self.mention_ent.values[mentions],
+            "link_indptr": np.r_[0, np.cumsum(n_links[doc_rows])].astype(links.indptr.dtype),
+            "link_indices": links.indices,
+            "link_counts": links.data,
+            "link_tf_idf": self.links_tf_idf,
+            "link_orig_indptr": np.r_[0, np.cumsum([len(orig) for orig in link_origs])].astype(np.int64),
+            "link_origs": np.array([o for orig in link_origs for o in orig], dtype=np.int32),
+        }
+        if self.concept_vectors is not None:
+            arrays["concept_vectors"] = self.concept_vectors.values
+        doc_ids = [str(self.doc_vectors.ids[row]) for row in doc_rows]
+        strings = {
+            "doc_ids": doc_ids,
+            "doc_titles": [str(self.doc_titles[row]) for row in doc_rows],
+            "doc_paths": [str(self.doc_paths[row]) for row in doc_rows],
+            "doc_types": [str(self.doc_types[row]) for row in doc_rows],
+            "doc_hashes": [str(self.doc_hashes[row]) for row in doc_rows],
+            "concept_names": self.concept_names,
+            "orig_texts": self.orig_texts,
+        }
+        meta = dict(
+            meta or {},
+            cutoffs=json.dumps(self.conf["cutoffs"], sort_keys=True),
+            openness=self.conf["openness"],
+            docs=docs_digest(
+                zip(doc_ids, strings["doc_hashes"], strings["doc_paths"], strings["doc_titles"])
+            ),
+            nb_docs_filtered=self.nb_docs_filtered,
+        )
+        write_snapshot(path, arrays, strings, meta)
+
+    def load_snapshot(self, snapshot):
+        """
+        Restore a mesh saved by `save_snapshot` from its Snapshot, into an empty mesh whose
+        `doc_cache` loads docs lazily, without reading any parsed doc. Its arrays are used in place: they are read
+        from disk as they are touched, and shared with the other processes that map the same
+        snapshot until the mesh changes them. Raises ValueError if the snapshot was saved with
+        other cutoffs.
+        """
+        if self.doc_vectors.ids or self.concept_names:
+            raise ValueError("The snapshot must be loaded into an empty mesh.")
+        if snapshot.meta["cutoffs"] != json.dumps(self.conf["cutoffs"], sort_keys=True):
+            raise ValueError("The snapshot was filtered with different cutoffs.")
+        self.version += 1
+        self.concepts_version += 1
+
+        ids = snapshot.strings("doc_ids")
+        self.doc_titles = snapshot.strings("doc_titles")
+        self.doc_paths = snapshot.strings("doc_paths")
+        self.doc_types = snapshot.strings("doc_types")
+        self.doc_hashes = snapshot.strings("doc_hashes")
+        self.doc_vectors.ids = ids
+        self.doc_vectors.rows = {id: row for row, id in enumerate(ids)}
+        self.doc_vectors.data = snapshot.array("doc_vectors")
+        self.doc_vectors.alive = np.ones(len(ids), dtype=bool)
+        for record in zip(ids, self.doc_titles, self.doc_paths, self.doc_hashes, self.doc_types):
+            self.doc_cache.add_record(*record)
+        self.doc_tf = snapshot.array("doc_tf")
+        self.nb_docs = len(ids)
+        self.nb_docs_filtered = snapshot.meta["nb_docs_filtered"]
+
+        names = snapshot.strings("concept_names")
+        self.concept_names = names
+        self.concept_ids = {name: cid for cid, name in enumerate(names)}
+        self.concept_cache = {names[cid]: cid for cid in snapshot.array("concept_cache").tolist()}
+        for name in (
+            "concept_has_vector",
+            "concept_is_ent",
+            "concept_count",
+            "concept_score",
+            "concept_base_score",
+            "concept_avg_tf_idf",
+            "mention_doc",
+            "mention_concept",
+            "mention_orig",
+            "mention_ent",
+        ):
+            setattr(self, name, Column.from_array(snapshot.array(name)))
+        if "concept_vectors" in snapshot:
+            self.concept_vectors = Column.from_array(snapshot.array("concept_vectors"))
+        self.orig_texts = snapshot.strings("orig_texts")
+        self.orig_ids = {text: i for i, text in enumerate(self.orig_texts)}
+        self._filtered_mentions = len(self.mention_doc)
+        self._stale = set()
+
+        self.links = sparse.csr_matrix(
+            (
+                snapshot.array("link_counts"),
+                snapshot.array("link_indices"),
+                snapshot.array("link_indptr"),
+            ),
+            shape=(len(ids), len(names)),
+        )
+        self.links_tf_idf = snapshot.array("link_tf_idf")
+        self.links_orig = LinkOrigs(
+            snapshot.array("link_orig_indptr"), snapshot.array("link_origs"), self.orig_texts
+        )
+        self._links_csc = None
+        self._raw_links = None
+
+    def _shown_concepts(self, max_conc=None):
+        """Concepts in the displayed graph, by decreasing score."""
         concepts = [
-            (c, self.graph.nodes[c]["score"]) for c in self.concept_cache.keys()
+            (c, self.concept_score.data[cid]) for c, cid in self.concept_cache.items()
         ]
         concepts.sort(key=lambda x: x[1], reverse=True)
-        dg = self.graph.copy()
-        for e in dg.edges(data=True):  # todo make this faster
-            dg[e[0]][e[1]]["orig"] = list(e[2]["orig"])  # remove set type for json dump
-
+        shown = dict(concepts)
         if max_conc and max_conc < len(concepts):
             for conc, score in concepts[
                 max_conc - 1 : -1
             ]:  # remove concepts below score
-                dg.remove_node(conc)
+                shown.pop(conc)
+        return shown
+
+    def _shown_edges(self, shown):
+        """(doc id, concept, attributes) of the links to the shown concepts."""
+        links = self._edges()
+        coo_rows = np.repeat(np.arange(links.shape[0]), np.diff(links.indptr))
+        for e, (row, cid) in enumerate(zip(coo_rows, links.indices)):
+            concept = self.concept_names[cid]
+            if concept in shown:
+                yield self.doc_vectors.ids[row], concept, {
+                    "count": int(links.data[e]),
+                    "orig": list(self.links_orig[e]) if self.links is not None else [],
+                    "tf_idf": float(self.links_tf_idf[e]) if self.links is not None else 0,
+                }
+
+    def display_graph(self, max_conc=None):
+        shown = self._shown_concepts(max_conc)
+        dg = networkx.DiGraph(openness=self.conf["openness"])
+        for id in self.doc_vectors.rows:
+            dg.add_node(id, **self.doc_info(id), type="doc")
+        for concept in shown:
+            dg.add_node(concept, **self.concept_info(concept), type="concept")
+        for doc_id, concept, data in self._shown_edges(shown):
+            dg.add_edge(doc_id, concept, **data)
         return dg
+
+    def iter_graph_json(self, max_conc=None, chunk_size=1000):
+        """
+        Node-link JSON of `display_graph`, as the frontend reads it, generated in chunks of
+        `chunk_size` nodes or links straight from the arrays of the mesh.
+        """
+        shown = self._shown_concepts(max_conc)
+        header = {"directed": True, "multigraph": False, "graph": {"openness": self.conf["openness"]}}
+        nodes = (
+            dict(self.doc_info(id), type="doc", id=id) for id in self.doc_vectors.rows
+        )
+        concepts = (
+            dict(self.concept_info(concept), type="concept", id=concept) for concept in shown
+        )
+        links = (
+            dict(data, source=doc_id, target=concept)
+            for doc_id, concept, data in self._shown_edges(shown)
+        )
+
+        def json_items(items):
+            chunk, sep = [], ""
+            for item in items:
+                chunk.append(json.dumps(item))
+                if len(chunk) == chunk_size:
+                    yield sep + ", ".join(chunk)
+                    chunk, sep = [], ", "
+            if chunk:
+                yield sep + ", ".join(chunk)
+
+        yield json.dumps(header)[:-1] + ', "nodes": ['
+        yield from json_items(itertools.chain(nodes, concepts))
+        yield '], "links": ['
+        yield from json_items(links)
+        yield "]}"
+
+    def save_graph(self, path, max_conc=None):
+        """
+        Write `iter_graph_json` to `path` and gzipped to `path`.gz, in a single pass and
+        atomically.
+        """
+        gz_path = path.with_name(path.name + ".gz")
+        tmp_path = path.with_name(path.name + ".tmp")
+        gz_tmp_path = path.with_name(path.name + ".gz.tmp")
+        with tmp_path.open("wb") as f, gzip.GzipFile(gz_tmp_path, "wb", mtime=0) as gz:
+            for chunk in self.iter_graph_json(max_conc):
+                data = chunk.encode()
+                f.write(data)
+                gz.write(data)
+        os.replace(gz_tmp_path, gz_path)
+        os.replace(tmp_path, path)
@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from itertools import chain, zip_longest
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from html2text import html2text
+from readability import Document
+from requests.adapters import HTTPAdapter
+
+
+def extract_article(html, url):
+    """Title and markdown text of the main content of a page."""
+    html_doc = Document(html)
+    return html_doc.short_title() or url, html2text(html_doc.summary(), bodywidth=0)
+
+
+class ArticleFetcher:
+    """
+    Fetches pages and extracts their article text, for /article_search.
+
+    Requests go through a shared session with pooled connections, at most `max_concurrent` at
+    once and one every `host_interval` seconds per host, and give up after `timeout`
+    (connect, read) seconds or a total of their sum.
+    Extracted articles are cached as JSON files in `cache_dir`: for `max_age` seconds they're
+    served as they are, then they are revalidated with their ETag / Last-Modified headers, so
+    unchanged pages aren't downloaded and extracted again. If a page can't be fetched, its
+    cached article is returned even if it's stale, otherwise the failure is cached too.
+    """
+
+    def __init__(
+        self,
+        cache_dir=None,
+        timeout=(3.05, 10),
+        max_concurrent=4,
+        pool_size=8,
+        max_age=3600,
+        max_bytes=5000000,
+        host_interval=1.0,
+        link_max_age=604800,
+    ):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.timeout = tuple(timeout)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.host_interval = host_interval
+        self.link_max_age = link_max_age
+        self.next_request = {}  # host -> earliest time of its next request
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.session = requests.Session()
+        self.session.headers["User-agent"] = "Espial/v0.1"
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.counts = {"cached": 0, "revalidated": 0, "fetched": 0, "failed": 0, "busy": 0}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(Path(config.data_dir) / ".articles", **config.FETCH)
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _cache_path(self, url):
+        return self.cache_dir / f"{sha256(url.encode()).hexdigest()}.json"
+
+    def _read_cache(self, url):
+        if self.cache_dir is None:
+            return None
+        try:
+            with self._cache_path(url).open("r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def _write_cache(self, entry):
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(exist_ok=True)
+        path = self._cache_path(entry["url"])
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with tmp_path.open("w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def _wait_for_host(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_request.get(host, now))
+            self.next_request[host] = slot + self.host_interval
+        time.sleep(slot - now)
+
+    def _download(self, url, headers):
+        """Response and body of a GET, with the body cut at `max_bytes`."""
+        deadline = time.monotonic() + sum(self.timeout)
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as resp:
+            chunks, size = [], 0
+            if resp.status_code != 304:
+                resp.raise_for_status()
+                for chunk in resp.iter_content(64 * 1024):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= self.max_bytes:
+                        break
+                    if time.monotonic() > deadline:
+                        raise requests.Timeout(f"Fetching {url} took too long")
+            return resp, b"".join(chunks)
+
+    def fetch(self, url, max_age=None, failure_max_age=300):
+        """
+        The article at `url` as a dict with its `url`, `title` and `text`, or None if it
+        couldn't be fetched and isn't cached. `max_age` overrides the one of the fetcher,
+        pages that couldn't be fetched are tried again after `failure_max_age` seconds.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        entry = self._read_cache(url)
+        if entry is not None:
+            age = time.time() - entry["checked"]
+            if age < (max_age if "text" in entry else failure_max_age):
+                self._count("cached")
+                return entry if "text" in entry else None
+            if "text" not in entry:
+                entry = None
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        self._wait_for_host(url)
+        if not self.slots.acquire(timeout=sum(self.timeout)):
+            self._count("busy")
+            return entry
+        try:
+            resp, body = self._download(url, headers)
+        except requests.RequestException:
+            return self._failed(url, entry)
+        finally:
+            self.slots.release()
+
+        if resp.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            entry["checked"] = time.time()
+        else:
+            try:
+                html = body.decode(resp.encoding or "utf-8", errors="replace")
+                title, text = extract_article(html, url)
+            except Exception:  # unknown encodings, readability fails on pages without content
+                return self._failed(url, entry)
+            self._count("fetched")
+            entry = {
+                "url": url,
+                "title": title,
+                "text": text,
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "checked": time.time(),
+            }
+        self._write_cache(entry)
+        return entry
+
+    def _failed(self, url, entry):
+        """Fall back to the stale article, or remember the failure so that it isn't retried."""
+        self._count("failed")
+        if entry is None:
+            self._write_cache({"url": url, "checked": time.time()})
+        return entry
+
+    def fetch_many(self, urls, max_age=None):
+        """
+        Fetch many pages with `max_concurrent` threads, returns a dict url -> article (or None).
+        Pages are interleaved by host so that rate-limited hosts don't hold every thread.
+        `max_age` defaults to `link_max_age`, longer than for single fetches. Pages that
+        couldn't be fetched are tried again after a day at most.
+        """
+        max_age = self.link_max_age if max_age is None else max_age
+        by_host = defaultdict(list)
+        for url in dict.fromkeys(urls):
+            by_host[urlsplit(url).netloc].append(url)
+        ordered = [
+            url for url in chain.from_iterable(zip_longest(*by_host.values())) if url
+        ]
+        with ThreadPoolExecutor(self.max_concurrent) as pool:
+            articles = pool.map(lambda url: self.fetch(url, max_age, min(max_age, 86400)), ordered)
+            return dict(zip(ordered, articles))
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,230 @@
+import os
+import time
+import zipfile
+import numpy as np
+from espial.datastruct import normalize, top_k
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbour index over document vectors.
+
+    Documents are clustered with spherical k-means and stored in one inverted list per
+    cluster. A query only scores the documents of the `n_probe` clusters closest to it.
+    """
+
+    def __init__(self, n_lists=0, n_probe=8, seed=0):
+        self.n_lists = n_lists  # 0 picks sqrt(number of docs) when building
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.assignments = {}  # doc id -> list number
+        self.hashes = {}  # doc id -> hash of the indexed content
+        self.members = []  # list number -> set of doc ids
+        self.n_trained = 0  # number of docs the centroids were trained on
+        self._rows = {}  # list number -> array of doc_vectors rows, rebuilt on change
+
+    def __len__(self):
+        return len(self.assignments)
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    def train(self, data, n_iter=10):
+        """Spherical k-means over the rows of `data` (which must be normalized)."""
+        rng = np.random.default_rng(self.seed)
+        self.assignments, self.hashes, self._rows = {}, {}, {}
+        if not len(data):
+            self.centroids = np.zeros((0, data.shape[1]), dtype=np.float32)
+            self.members = []
+            return
+        n_lists = self.n_lists or int(np.sqrt(len(data)))
+        n_lists = max(1, min(n_lists, len(data)))
+        if len(data) > 256 * n_lists:  # a sample is enough to place the centroids
+            data = data[rng.choice(len(data), 256 * n_lists, replace=False)]
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assigned = self._nearest(data, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, data)
+            empty = ~sums.any(axis=1)
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True).clip(1e-12)
+        self.centroids = centroids.astype(np.float32)
+        self.members = [set() for _ in range(n_lists)]
+
+    @staticmethod
+    def _nearest(data, centroids, chunk=8192):
+        """Closest centroid of every row of `data`, computed in chunks to bound memory."""
+        nearest = np.zeros(len(data), dtype=np.int64)
+        for i in range(0, len(data), chunk):
+            nearest[i : i + chunk] = np.argmax(data[i : i + chunk] @ centroids.T, axis=1)
+        return nearest
+
+    def build(self, mesh):
+        """Train the clusters on the mesh's documents and index all of them."""
+        vectors = mesh.doc_vectors
+        rows = np.flatnonzero(vectors.alive_mask)
+        self.train(vectors.matrix[rows])
+        self.n_trained = len(rows)
+        for row, list_no in zip(rows, self._nearest(vectors.matrix[rows], self.centroids)):
+            id = vectors.ids[row]
+            self._assign(id, int(list_no), mesh.doc_cache[id]._.hash)
+
+    def _assign(self, id, list_no, hash):
+        self.assignments[id] = list_no
+        self.hashes[id] = hash
+        self.members[list_no].add(id)
+        self._rows.pop(list_no, None)
+
+    def add(self, id, vector, hash=None):
+        """Index a new or changed document."""
+        self.remove(id)
+        if not self.members:  # not trained yet, the next sync builds the index
+            return
+        list_no = int(np.argmax(self.centroids @ normalize(vector)))
+        self._assign(id, list_no, hash)
+
+    def remove(self, id):
+        list_no = self.assignments.pop(id, None)
+        if list_no is None:
+            return
+        self.hashes.pop(id, None)
+        self.members[list_no].discard(id)
+        self._rows.pop(list_no, None)
+
+    def sync(self, mesh):
+        """
+        Bring the index up to date with the mesh, indexing only new or changed documents.
+        Returns whether anything changed.
+        """
+        vectors = mesh.doc_vectors
+        changed = False
+        for id in [id for id in self.assignments if id not in vectors]:
+            self.remove(id)
+            changed = True
+        for id in vectors.rows:
+            hash = mesh.doc_cache[id]._.hash
+            if id not in self.assignments or self.hashes.get(id) != hash:
+                self.add(id, vectors.vector(id), hash)
+                changed = True
+        if len(vectors) > 4 * max(self.n_trained, 1) or (
+            len(vectors) and not self.members
+        ):  # clusters no longer fit the data
+            self.build(mesh)
+            changed = True
+        return changed
+
+    def candidates(self, vector, doc_vectors, n_probe=None):
+        """Rows of `doc_vectors` in the clusters closest to the vector."""
+        n_probe = min(n_probe or self.n_probe, len(self.members))
+        probed = top_k(self.centroids @ normalize(vector), n_probe)
+        rows = []
+        for list_no in probed:
+            if list_no not in self._rows:
+                self._rows[list_no] = np.array(
+                    [doc_vectors.rows[id] for id in self.members[list_no]],
+                    dtype=np.int64,
+                )
+            rows.append(self._rows[list_no])
+        return np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    def save(self, path):
+        """Save the index atomically, so that an interrupted save leaves the previous one."""
+        ids = list(self.assignments)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with tmp_path.open("wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                ids=np.array(ids, dtype=str),
+                lists=np.array([self.assignments[id] for id in ids], dtype=np.int32),
+                hashes=np.array([self.hashes[id] or "" for id in ids], dtype=str),
+                params=np.array([self.n_lists, self.n_probe, self.seed, self.n_trained]),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            n_lists, n_probe, seed, n_trained = saved["params"].tolist()
+            index = cls(n_lists, n_probe, seed)
+            index.centroids = saved["centroids"]
+            index.n_trained = n_trained
+            index.members = [set() for _ in range(len(index.centroids))]
+            for id, list_no, hash in zip(saved["ids"], saved["lists"], saved["hashes"]):
+                index._assign(str(id), int(list_no), str(hash) or None)
+        return index
+
+
+def load_ann_index(mesh, path):
+    """Load the persisted index at `path`, updating it for changed docs, or build a new one."""
+    conf = mesh.conf["search"]
+    index = None
+    if path.exists():
+        try:
+            index = IVFIndex.load(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):  # rebuilt below
+            index = None
+    if (
+        index is None
+        or index.n_lists != conf["n_lists"]
+        or index.dim != mesh.doc_vectors.matrix.shape[1]
+    ):
+        index = IVFIndex(conf["n_lists"], conf["n_probe"])
+        index.build(mesh)
+        index.save(path)
+    else:
+        index.n_probe = conf["n_probe"]
+        if index.sync(mesh):
+            index.save(path)
+    return index
+
+
+def recall_report(mesh, index, n_queries=100, top_n=10, n_probes=(1, 2, 4, 8, 16, 32)):
+    """
+    Compare approximate search to exact search on documents of the mesh used as queries.
+    Returns one row per `n_probe` value with recall@top_n and latencies in milliseconds.
+    """
+    vectors = mesh.doc_vectors
+    rng = np.random.default_rng(0)
+    alive = np.flatnonzero(vectors.alive_mask)
+    queries = vectors.matrix[rng.choice(alive, min(n_queries, len(alive)), replace=False)]
+
+    exact, exact_times = [], []
+    for q in queries:
+        start = time.perf_counter()
+        sims = np.where(vectors.alive_mask, vectors.matrix @ q, -np.inf)
+        exact.append(set(top_k(sims, top_n).tolist()))
+        exact_times.append(time.perf_counter() - start)
+    report = [
+        {
+            "mode": "exact",
+            "n_probe": None,
+            "recall": 1.0,
+            "mean_ms": float(np.mean(exact_times)) * 1000,
+            "p95_ms": float(np.percentile(exact_times, 95)) * 1000,
+        }
+    ]
+
+    for n_probe in n_probes:
+        if n_probe > len(index.members):
+            break
+        recalls, times = [], []
+        for q, truth in zip(queries, exact):
+            start = time.perf_counter()
+            rows = index.candidates(q, vectors, n_probe)
+            found = rows[top_k(vectors.matrix[rows] @ q, top_n)]
+            times.append(time.perf_counter() - start)
+            recalls.append(len(truth.intersection(found.tolist())) / max(len(truth), 1))
+        report.append(
+            {
+                "mode": "approximate",
+                "n_probe": n_probe,
+                "recall": float(np.mean(recalls)),
+                "mean_ms": float(np.mean(times)) * 1000,
+                "p95_ms": float(np.percentile(times, 95)) * 1000,
+            }
+        )
+    return report
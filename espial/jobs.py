@@ -0,0 +1,139 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+from pathlib import Path
+
+
+def write_atomic(path, contents):
+    """Replace a file's contents through a temporary file, so it is never half-written."""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{threading.get_ident()}.tmp")
+    with tmp_path.open("w") as f:
+        f.write(contents)
+    if path.exists():
+        shutil.copymode(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_if_changed(path, contents):
+    """
+    Write a file only if its contents hash differs from the one on disk, so unchanged files keep
+    their mtime (and aren't synced again). Returns whether it was written.
+    """
+    path = Path(path)
+    try:
+        with path.open("rb") as f:
+            if sha256(f.read()).digest() == sha256(contents.encode()).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    write_atomic(path, contents)
+    return True
+
+
+class Job:
+    """
+    Bulk operation over the `items` of a dict, processed in a thread pool of `max_workers`.
+    Subclasses implement `process(key, value)`, which returns whether it changed something.
+    Items that fail are recorded in `errors`, the others go on. The job ends "done", or
+    "failed" if it couldn't run its items.
+    """
+
+    name = "job"
+
+    def __init__(self, items, max_workers=8):
+        self.items = items
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.state = "pending"
+        self.done = 0
+        self.changed = 0
+        self.errors = {}  # key -> error
+        self.started = None
+        self.finished = None
+
+    def process(self, key, value):
+        raise NotImplementedError
+
+    def run(self):
+        self.started = time.time()
+        self.state = "running"
+        state = "failed"
+        try:
+            with ThreadPoolExecutor(self.max_workers) as pool:
+                futures = {
+                    pool.submit(self.process, key, value): key
+                    for key, value in self.items.items()
+                }
+                for future in as_completed(futures):
+                    with self.lock:
+                        self.done += 1
+                        try:
+                            self.changed += future.result()
+                        except Exception as e:
+                            self.errors[str(futures[future])] = repr(e)
+            state = "done"
+        finally:
+            with self.lock:
+                self.finished = time.time()
+                self.state = state
+        return self
+
+    def status(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "state": self.state,
+                "total": len(self.items),
+                "done": self.done,
+                "changed": self.changed,
+                "errors": dict(self.errors),
+                "seconds": round((self.finished or time.time()) - self.started, 3)
+                if self.started
+                else None,
+            }
+
+
+class WriteJob(Job):
+    """Writes files, given as a dict path -> contents, skipping those that didn't change."""
+
+    def __init__(self, name, files, max_workers=8):
+        super().__init__(files, max_workers)
+        self.name = name
+
+    def process(self, path, contents):
+        return write_if_changed(path, contents)
+
+
+class JobRunner:
+    """
+    Runs jobs in the background, at most one of each name at a time, and keeps the last job of
+    each name so that its status can be served while and after it runs.
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="espial-jobs")
+        self.jobs = {}  # name -> last job started
+        self.lock = threading.Lock()
+
+    def start(self, job):
+        """Queue a job, unless one with the same name is still pending or running."""
+        with self.lock:
+            last = self.jobs.get(job.name)
+            if last is not None and last.state in ("pending", "running"):
+                return False
+            self.jobs[job.name] = job
+        self.executor.submit(job.run)
+        return True
+
+    def get(self, name):
+        with self.lock:
+            return self.jobs.get(name)
+
+    def status(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return {job.name: job.status() for job in jobs}
@@ -1,76 +1,254 @@
+import os
 import time
 import json
-from spacy.tokens import DocBin, Doc
+from concurrent.futures import ThreadPoolExecutor
+from spacy.tokens import Doc
 from espial.datastruct import ConceptMesh
-from espial.analysis import process_markdown
+from espial.analysis import extract_urls, process_markdown
+from espial.fetch import ArticleFetcher
+from espial.index import load_ann_index
+from espial.matcher import ConceptMatcher
+from espial.metrics import metrics
+from espial.snapshot import Snapshot, docs_digest
+from espial.store import AnnotationStore, DocCache
 import networkx
 import spacy
 from pathlib import Path
 from hashlib import sha256
+from urllib.parse import urldefrag
 
 hash_fn = lambda item: sha256(item["content"].encode()).hexdigest()
 
 
-def load_mesh(config):
-    data_dir = Path(config.data_dir)
-    openness = config.ANALYSIS["openness"]
-    rerun = config.ANALYSIS["rerun"]
-    nlp = spacy.load("en_core_web_md")
-    Doc.set_extension("title", default=None)
-    Doc.set_extension("id", default=None)
-    Doc.set_extension("path", default=None)
-    Doc.set_extension("hash", default=None)
+def read_item(path, config):
+    content = path.open("r").read()
+    item = {
+        "content": content,
+        "title": config.get_title(path, content),
+        "path": str(path),
+    }
+    item["hash"] = hash_fn(item)
+    item["id"] = config.get_item_id(item)
+    item["urls"] = extract_urls(content)
+    return item
+
+
+def scan_items(config, data_dir):
+    """
+    Find the knowledge base's documents. A manifest of each file's stat, hash, id and title is
+    saved in `.manifest.json`, so only files whose stat changed since the last run are read and
+    hashed (in a thread pool). Items of unchanged files have no "content", every item has
+    the "urls" it links to.
+    """
+    manifest_path = data_dir / ".manifest.json"
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            manifest = json.load(manifest_path.open("r"))
+        except ValueError:
+            manifest = {}
+    new_manifest = {}
     items = {}
+    changed = []
     for path in data_dir.rglob("*.md"):
         if any([path.parent == data_dir / p for p in config.IGNORE]):
             continue
-        content = path.open("r").read()
+        stat = path.stat()
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        entry = manifest.get(str(path))
+        if entry and entry["stat"] == key and "urls" in entry:
+            new_manifest[str(path)] = entry
+            items[entry["id"]] = {
+                "title": entry["title"],
+                "path": str(path),
+                "hash": entry["hash"],
+                "urls": entry["urls"],
+            }
+        else:
+            changed.append((path, key))
+    with ThreadPoolExecutor() as pool:
+        for (path, key), item in zip(
+            changed, pool.map(lambda x: read_item(x[0], config), changed)
+        ):
+            new_manifest[str(path)] = {
+                "stat": key,
+                "hash": item["hash"],
+                "id": item["id"],
+                "title": item["title"],
+                "urls": item["urls"],
+            }
+            items[item.pop("id")] = item
+    if new_manifest != manifest:
+        tmp_path = manifest_path.with_suffix(".tmp")
+        json.dump(new_manifest, tmp_path.open("w"))
+        os.replace(tmp_path, manifest_path)
+    return items
+
+
+def scrape_items(config, items):
+    """
+    Items of type "external" for the articles linked from the notes. Links are deduplicated
+    and fetched concurrently by an ArticleFetcher, which caches them in `.articles`.
+    """
+    urls = [urldefrag(url)[0] for item in items.values() for url in item["urls"]]
+    fetcher = ArticleFetcher.from_config(config)
+    with metrics.span("scrape") as scrape:
+        articles = fetcher.fetch_many(urls)
+    external = {}
+    for url, article in articles.items():
+        if article is None or not article["text"].strip():
+            continue
         item = {
-            "content": content,
-            "title": config.get_title(path, content),
-            "path": str(path),
+            "content": article["text"],
+            "title": article["title"],
+            "path": url,
+            "doc_type": "external",
         }
         item["hash"] = hash_fn(item)
-        items[config.get_item_id(item)] = item
+        item["id"] = config.get_item_id(item)
+        if item["id"] not in items:
+            external[item.pop("id")] = item
+    stats = fetcher.stats()
+    print(
+        scrape.seconds,
+        f"time spent to scrape {len(articles)} links: {stats['fetched']} fetched, "
+        f"{stats['revalidated']} unchanged, {stats['cached']} cached, {stats['failed']} failed",
+    )
+    return external
+
+
+def restore_snapshot(config, items, store, nlp):
+    """
+    The mesh saved to `.mesh_snapshot` by `save_snapshot`, mapped in place with its docs loaded
+    lazily, or None if there is no snapshot or the notes, the model or the analysis settings
+    changed since it was saved.
+    """
+    path = Path(config.data_dir) / ".mesh_snapshot"
+    if not path.exists() or not all(item["hash"] in store for item in items.values()):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring the snapshot: {e}")
+        return None
+    meta = snapshot.meta
+    if (
+        meta.get("model") != str(config.model)
+        or meta["openness"] != config.ANALYSIS["openness"]
+        or meta["docs"]
+        != docs_digest(
+            (id, item["hash"], item["path"], item["title"]) for id, item in items.items()
+        )
+    ):
+        return None
+    doc_cache = DocCache(store, nlp.vocab, config.ANALYSIS["lazy_docs"]["cache_size"])
+    mesh = ConceptMesh(config.ANALYSIS, doc_cache)
+    try:
+        mesh.load_snapshot(snapshot)
+    except (KeyError, ValueError):
+        return None
+    if config.QUERY["matcher"]:
+        mesh.concept_matcher = ConceptMatcher(mesh, nlp.tokenizer)
+    return mesh
+
+
+def save_snapshot(mesh, config):
+    """Save the analyzed mesh for `restore_snapshot`, if ANALYSIS["snapshot"] is enabled."""
+    if not config.ANALYSIS["snapshot"]:
+        return
+    with metrics.span("save_snapshot") as span:
+        try:
+            mesh.save_snapshot(Path(config.data_dir) / ".mesh_snapshot", {"model": str(config.model)})
+        except (OSError, ValueError) as e:
+            print(f"Couldn't save the snapshot: {e}")
+    print(span.seconds, "time spent to save the snapshot")
+
+
+def load_search_index(config, mesh):
+    if config.ANALYSIS["search"]["mode"] == "approximate":
+        with metrics.span("ann_index") as ann:
+            mesh.ann_index = load_ann_index(mesh, Path(config.data_dir) / ".ann_index")
+        print(ann.seconds, "time spent to update the approximate search index")
+
+
+def load_mesh(config, progress=None):
+    """
+    Load the knowledge base into a ConceptMesh, parsing new docs. `progress(done, total)` is
+    called as new docs are parsed. With incremental analysis and ANALYSIS["snapshot"], the
+    mesh is mapped from its snapshot when no note changed since it was saved.
+    """
+    data_dir = Path(config.data_dir)
+    openness = config.ANALYSIS["openness"]
+    rerun = config.ANALYSIS["rerun"]
+    nlp = spacy.load(config.model)
+    # force: the mesh can be loaded more than once in a process (eg in benchmarks)
+    Doc.set_extension("title", default=None, force=True)
+    Doc.set_extension("id", default=None, force=True)
+    Doc.set_extension("path", default=None, force=True)
+    Doc.set_extension("hash", default=None, force=True)
+    Doc.set_extension("doc_type", default="note", force=True)
+    with metrics.span("scan"):
+        items = scan_items(config, data_dir)
+    if config.ANALYSIS["scrape_links"]:
+        items.update(scrape_items(config, items))
     saved_graph = data_dir / ".graph.json"
-    doc_cache = {}
+    saved_state = data_dir / ".mesh_state"
     a = time.time()
-    docs = []
-    dumped_annot = data_dir / ".doc_annotations"
-    if dumped_annot.exists():
-        with dumped_annot.open("rb") as f:
-            doc_bin = DocBin(store_user_data=True).from_bytes(f.read())
-            deleted_docs = False
-            for doc in doc_bin.get_docs(nlp.vocab):
-                doc._.id = str(doc._.id)
-                excluded_path = any(
-                    [Path(doc._.path).parent == data_dir / p for p in config.IGNORE]
-                )
-                if (
-                    doc._.id in items
-                    and doc._.hash == items[doc._.id]["hash"]
-                    and not excluded_path
-                    and Path(doc._.path).exists()
-                ):
-                    docs.append(doc)
-                else:
-                    deleted_docs = True
-            if deleted_docs:  # we need to rerun the analysis
-                rerun = 1
-                doc_bin = DocBin(store_user_data=True)
-                for doc in docs:
-                    doc_bin.add(doc)
-            doc_cache = {doc._.id: doc for doc in docs}
-    else:
-        doc_bin = DocBin(store_user_data=True)
+    store = AnnotationStore(data_dir / ".annotations")
+    legacy_annot = data_dir / ".doc_annotations"
+    if legacy_annot.exists():  # older versions saved every doc in a single DocBin
+        store.migrate(legacy_annot, nlp.vocab)
+    use_snapshot = (
+        config.ANALYSIS["snapshot"]
+        and config.ANALYSIS["incremental"]["enabled"]
+        and not config.ANALYSIS["rerun"]
+    )
+    if use_snapshot:
+        with metrics.span("snapshot") as span:
+            mesh = restore_snapshot(config, items, store, nlp)
+        if mesh is not None:
+            print(span.seconds, f"time spent to map the snapshot of {len(mesh.doc_vectors)} docs")
+            load_search_index(config, mesh)
+            if progress is not None:
+                progress(0, 0)
+            return mesh, nlp, 0
+    live_hashes = {item["hash"] for item in items.values()}
+    if store.live - live_hashes:  # docs were deleted or modified, we need to rerun the analysis
+        rerun = 1
+    lazy_docs = config.ANALYSIS["lazy_docs"]
+    doc_cache = DocCache(
+        store, nlp.vocab, lazy_docs["cache_size"] if lazy_docs["enabled"] else None
+    )
+    cached = {id: item for id, item in items.items() if item["hash"] in store}
+
+    def cached_docs():
+        """Parsed docs of unchanged notes, read in the order of the store's log."""
+        ids = {}
+        for id, item in cached.items():
+            ids.setdefault(item["hash"], []).append(id)
+        for hash, doc in store.get_many(set(ids), nlp.vocab):
+            for n, id in enumerate(ids[hash]):
+                if n:  # several notes with the same contents
+                    doc = store.get(hash, nlp.vocab)
+                doc._.id = id
+                doc._.title = cached[id]["title"]
+                doc._.path = cached[id]["path"]
+                doc._.hash = hash
+                doc._.doc_type = cached[id].get("doc_type", "note")
+                yield doc
 
     mesh = ConceptMesh(config.ANALYSIS, doc_cache)
-    mesh.nb_docs = len(docs)
+    if config.QUERY["matcher"]:
+        mesh.concept_matcher = ConceptMatcher(mesh, nlp.tokenizer)
 
     unseen_docs = []
     for id, item in items.items():
+        if id in cached:
+            continue
+        if "content" not in item:
+            item["content"] = Path(item["path"]).open("r").read()
         item["content"] = process_markdown(item["content"])
-        if not id in doc_cache and len(item["content"]) < 1000000:
+        if len(item["content"]) < 1000000:
             unseen_docs.append(
                 (
                     item["content"],
@@ -79,55 +257,104 @@ def load_mesh(config):
                         "title": item["title"],
                         "path": item["path"],
                         "hash": item["hash"],
+                        "doc_type": item.get("doc_type", "note"),
                     },
                 )
             )
     if unseen_docs:
         rerun = 1
 
-    if saved_graph.exists() and not rerun:
-        loaded_graph = networkx.json_graph.node_link_graph(
-            json.load(saved_graph.open("r"))
-        )
-        if openness != loaded_graph.graph["openness"]:
+    incremental = (
+        config.ANALYSIS["incremental"]["enabled"]
+        and not config.ANALYSIS["rerun"]
+        and saved_state.exists()
+    )
+    loaded_graph = None
+    if incremental:  # restore the saved concepts, only changed docs are analyzed again
+        for doc in cached_docs():
+            mesh.process_document(doc, index_concepts=False)
+        try:
+            missing = mesh.load_state(saved_state)
+        except (OSError, ValueError, KeyError):
+            incremental = False
+            missing = list(mesh.doc_vectors.rows)
             rerun = 1
-        else:
-            for node in loaded_graph.nodes():
-                if loaded_graph.nodes[node]["type"] == "concept":
-                    mesh.concept_cache[
-                        node
-                    ] = None  # we want to access concepts in concept_cache but don't need the vector emb
-            mesh.graph = loaded_graph
+        for id in missing:
+            mesh.index_doc_concepts(doc_cache.doc(id))
     else:
-        rerun = 1
+        if saved_graph.exists() and not rerun:
+            loaded_graph = networkx.json_graph.node_link_graph(
+                json.load(saved_graph.open("r"))
+            )
+            if openness != loaded_graph.graph["openness"]:
+                rerun = 1
+                loaded_graph = None
+        else:
+            rerun = 1
 
-    list(map(lambda x: mesh.process_document(x, index_concepts=rerun), docs))
+        for doc in cached_docs():
+            mesh.process_document(doc, index_concepts=rerun)
+        if loaded_graph is not None:
+            mesh.load_graph(loaded_graph)
     print(f"{len(unseen_docs)} new docs.")
+    parse1 = time.time()
+    metrics.record_stage("restore", parse1 - a)  # parsed docs and concepts saved by earlier runs
+    if progress is not None:
+        progress(0, len(unseen_docs))
     i = 0
+    n_process = config.ANALYSIS["n_process"]
+    if len(unseen_docs) < 2 * config.ANALYSIS["batch_size"]:
+        n_process = 1  # not worth starting worker processes
+    new_docs = []
+    n_new = 0
     for doc, ctx in nlp.pipe(
         unseen_docs,
         as_tuples=True,
         disable=["textcat"],
         batch_size=config.ANALYSIS["batch_size"],
+        n_process=n_process,
     ):
         i += 1
         if i % config.ANALYSIS["batch_size"] == 0:
             print(f"{i} docs processed.")
+            if progress is not None:
+                progress(i, len(unseen_docs))
         doc._.title = ctx["title"]
         doc._.id = ctx["id"]
         doc._.path = ctx["path"]
         doc._.hash = ctx["hash"]
-        doc_bin.add(doc)
+        doc._.doc_type = ctx["doc_type"]
+        new_docs.append(doc)
         if (
-            ctx["id"] in doc_cache and ctx["id"] in mesh.graph
+            ctx["id"] in doc_cache and mesh.has_doc(ctx["id"])
         ):  # update old documents that have changed
             mesh.remove_doc(ctx["id"])
         mesh.process_document(doc)
+        if len(new_docs) == config.ANALYSIS["batch_size"]:
+            store.put_many(new_docs)  # save each batch so parsed docs don't pile up in memory
+            n_new += len(new_docs)
+            new_docs = []
 
+    metrics.record_stage("parse", time.time() - parse1)
     print(
         time.time() - a, f"time spent to process docs, of {len(unseen_docs)} new ones."
     )
-    if len(unseen_docs):
-        with dumped_annot.open("wb") as f:
-            f.write(doc_bin.to_bytes())
+    store.put_many(new_docs)
+    n_new += len(new_docs)
+    live_hashes = {doc._.hash for doc in mesh.doc_cache.values()}
+    if n_new or live_hashes != store.live:
+        store.flush(live_hashes)
+    if store.stale_ratio() > 0.5:
+        store.compact()
+    if incremental:
+        with metrics.span("update") as update:
+            n_updated = mesh.update_concepts(config.ANALYSIS["incremental"]["max_idf_drift"])
+            if n_updated or missing:
+                mesh.save_state(saved_state)
+        print(update.seconds, f"time spent to update {n_updated} changed concepts")
+        save_snapshot(mesh, config)  # the snapshot, if any, didn't match the notes
+        rerun = 0
+    load_search_index(config, mesh)
+    if progress is not None:
+        progress(len(unseen_docs), len(unseen_docs))
     return mesh, nlp, rerun
@@ -0,0 +1,58 @@
+import threading
+
+import numpy as np
+from spacy.matcher import PhraseMatcher
+
+
+class ConceptMatcher:
+    """
+    Finds the concepts of a mesh in a doc that was only tokenized.
+
+    A PhraseMatcher on lowercased tokens matches each concept's name and every text that was
+    mapped to it when analyzing the docs (eg "Databases" for "database"), so queries don't need
+    to be tagged, parsed and lemmatized like the docs were. It is built on first use, and again
+    once `mesh.concepts_version` changed.
+    """
+
+    def __init__(self, mesh, tokenizer):
+        self.mesh = mesh
+        self.tokenizer = tokenizer
+        self.matcher = None
+        self.version = None  # concepts_version of the mesh the matcher was built for
+        self.lock = threading.Lock()
+
+    def patterns(self):
+        """concept -> texts that mention it"""
+        mesh = self.mesh
+        pairs = np.unique(
+            np.stack([mesh.mention_concept.values, mesh.mention_orig.values], axis=1), axis=0
+        )
+        patterns = {concept: {concept} for concept in mesh.concept_cache}
+        for cid, orig in pairs:
+            concept = mesh.concept_names[cid]
+            if concept in patterns:
+                patterns[concept].add(mesh.orig_texts[orig].lower())
+        return patterns
+
+    def _build(self):
+        matcher = PhraseMatcher(self.tokenizer.vocab, attr="LOWER")
+        for concept, texts in self.patterns().items():
+            matcher.add(concept, list(self.tokenizer.pipe(sorted(texts))))
+        return matcher
+
+    def get_matcher(self):
+        with self.lock:
+            if self.version != self.mesh.concepts_version:
+                version = self.mesh.concepts_version
+                self.matcher = self._build()
+                self.version = version
+            return self.matcher
+
+    def __call__(self, doc):
+        """Names of the concepts found in a doc."""
+        strings = doc.vocab.strings
+        return {
+            strings[match_id]
+            for match_id, _, _ in self.get_matcher()(doc)
+            if strings[match_id] in self.mesh.concept_cache
+        }
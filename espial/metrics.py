@@ -0,0 +1,195 @@
+import cProfile
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> type, help of the metrics Espial records
+FAMILIES = {
+    "espial_stage_seconds": ("gauge", "Duration of the last run of a stage of loading or updating the mesh."),
+    "espial_stage_runs_total": ("counter", "Runs of each stage of loading or updating the mesh."),
+    "espial_request_duration_seconds": ("histogram", "Latency of the requests to each route."),
+    "espial_requests_total": ("counter", "Requests to each route, by status code."),
+    "espial_docs": ("gauge", "Documents in the mesh."),
+    "espial_concepts": ("gauge", "Concepts in the mesh."),
+    "espial_edges": ("gauge", "Links between documents and concepts."),
+    "espial_cache_entries": ("gauge", "Entries of each result cache."),
+    "espial_cache_hits_total": ("counter", "Lookups found in each result cache."),
+    "espial_cache_misses_total": ("counter", "Lookups missing from each result cache."),
+    "process_resident_memory_bytes": ("gauge", "Resident memory of the process."),
+}
+
+
+def resident_bytes():
+    """Current resident set size, or the peak one where /proc isn't available."""
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}"
+        yield f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {self.count}"
+        yield f"{name}_sum{_labels(labels)} {self.sum}"
+        yield f"{name}_count{_labels(labels)} {self.count}"
+
+
+class Span:
+    """Duration of a `Metrics.span`, in `seconds` once it ended."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the FAMILIES, by labels, rendered in the Prometheus text
+    format for /metrics. Gauges of the current state of the mesh are set when rendering.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: {} for name in FAMILIES}  # name -> labels -> value or Histogram
+        # a thread of the parent, eg the watcher's, may hold the lock while a worker is forked
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[name][labels] = value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            series = self.values[name]
+            if labels not in series:
+                series[labels] = Histogram()
+            series[labels].observe(value)
+
+    @contextmanager
+    def span(self, stage):
+        """Time a stage, eg `with metrics.span("parse") as parse:`, then `parse.seconds`."""
+        span = Span(stage)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.seconds = time.perf_counter() - start
+            self.record_stage(stage, span.seconds)
+
+    def record_stage(self, stage, seconds):
+        self.set("espial_stage_seconds", seconds, (("stage", stage),))
+        self.inc("espial_stage_runs_total", (("stage", stage),))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help) in FAMILIES.items():
+                series = self.values[name]
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(series.items()):
+                    if kind == "histogram":
+                        lines.extend(value.lines(name, labels))
+                    else:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()  # shared by load_mesh, the startup stages and the app
+
+
+class RequestProfiler:
+    """
+    Profiles requests with cProfile or pyinstrument, one at a time, and saves the profiles of
+    those slower than `min_seconds` to `profile_dir`: `<endpoint>-<time>.prof` files to open
+    with pstats or snakeviz, or `.html` ones for pyinstrument.
+    """
+
+    def __init__(self, profile_dir, kind="cprofile", min_seconds=1.0):
+        if kind == "pyinstrument" and Profiler is None:
+            raise ImportError("pyinstrument is needed to profile requests with it")
+        self.profile_dir = Path(profile_dir)
+        self.kind = kind
+        self.min_seconds = min_seconds
+        self.busy = threading.Lock()  # profilers can't run in two threads at once
+
+    def start(self):
+        """A running profiler, or None if another request is being profiled."""
+        if not self.busy.acquire(blocking=False):
+            return None
+        profiler = Profiler() if self.kind == "pyinstrument" else cProfile.Profile()
+        try:
+            profiler.start() if self.kind == "pyinstrument" else profiler.enable()
+        except Exception:
+            self.busy.release()
+            raise
+        return profiler
+
+    def stop(self, profiler, name, seconds, force=False):
+        """Stop a profiler, and save its profile if the request was slow. Returns its path."""
+        try:
+            profiler.stop() if self.kind == "pyinstrument" else profiler.disable()
+        finally:
+            self.busy.release()
+        if seconds < self.min_seconds and not force:
+            return None
+        self.profile_dir.mkdir(exist_ok=True)
+        stem = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{int(seconds * 1000)}ms"
+        if self.kind == "pyinstrument":
+            path = self.profile_dir / f"{stem}.html"
+            path.write_text(profiler.output_html())
+        else:
+            path = self.profile_dir / f"{stem}.prof"
+            profiler.dump_stats(path)
+        return path
@@ -0,0 +1,213 @@
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+from espial import create_app
+
+
+class InFlight:
+    """WSGI middleware counting the requests being answered, so that workers finish them before exiting."""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def _done(self):
+        with self.lock:
+            self.count -= 1
+
+    def __call__(self, environ, start_response):
+        with self.lock:
+            self.count += 1
+        try:
+            body = self.app(environ, start_response)
+        except BaseException:
+            self._done()
+            raise
+        return ClosingIterator(body, self._done)
+
+
+class PreforkServer:
+    """
+    Serves Espial from `workers` processes forked once the mesh is loaded, so that they share
+    its memory copy-on-write instead of each loading their own, and answer requests in parallel.
+
+    The workers accept connections on a socket opened by the master process, which restarts
+    them when they die. On SIGHUP, the master loads the mesh again (incrementally, so only
+    changed notes are parsed) while the old workers keep serving, then forks new workers and
+    lets the old ones finish their requests. With WATCH["enabled"], the master folds changed
+    notes into its mesh and forks new workers in the same way. SIGTERM or SIGINT stop the
+    workers gracefully: requests they started have `graceful_timeout` seconds to finish.
+
+    Each worker keeps its own caches and jobs, see /cache_stats and /jobs.
+    """
+
+    def __init__(self, config, workers=None, graceful_timeout=30):
+        self.config = config
+        self.n_workers = workers or os.cpu_count() or 1
+        self.graceful_timeout = graceful_timeout
+        self.app = None
+        self.socket = None
+        self.workers = set()  # pids of the workers of the current app
+        self.retiring = set()  # pids of the workers finishing their requests before exiting
+        self.reload_requested = False  # load the mesh again
+        self.refork_requested = False  # the mesh changed, fork workers that have the change
+        self.stopping = False
+
+    def build(self):
+        """Create the app and wait for its mesh to be loaded."""
+        app = create_app(self.config)
+        app.startup.wait()
+        status = app.startup.status()
+        if status["failed"]:
+            failed = [stage for stage in status["stages"] if stage["state"] == "failed"]
+            raise RuntimeError(f"Espial failed to start: {failed}")
+        app.update_hooks.append(self.request_refork)
+        self.config.ANALYSIS["rerun"] = 0  # reloads only analyze the notes that changed
+        return app
+
+    def request_refork(self):
+        self.refork_requested = True
+
+    def spawn(self):
+        app = self.app
+        gc.collect()
+        # no update is half-done in the mesh workers get: the watcher can't write while the
+        # master reads. The lock starts over unlocked in the worker (see ReadWriteLock), so
+        # only the master releases it.
+        app.mesh_lock.acquire_read()
+        pid = None
+        try:
+            gc.freeze()  # the gc of workers doesn't touch the objects of the mesh, keeping them shared
+            pid = os.fork()
+        finally:
+            if pid != 0:
+                app.mesh_lock.release_read()
+        if pid == 0:
+            self._run_worker(app)
+        self.workers.add(pid)
+        return pid
+
+    def _run_worker(self, app):
+        """Serve requests until SIGTERM, in a forked process. Never returns."""
+        try:
+            for sig in (signal.SIGHUP, signal.SIGINT):
+                signal.signal(sig, signal.SIG_IGN)  # the master handles them
+            inflight = InFlight(app)
+            server = make_server(
+                self.config.host, self.config.port, inflight, threaded=True, fd=self.socket.fileno()
+            )
+
+            def stop(signum, frame):
+                threading.Thread(target=server.shutdown, daemon=True).start()
+
+            signal.signal(signal.SIGTERM, stop)
+            server.serve_forever(poll_interval=0.5)
+            deadline = time.monotonic() + self.graceful_timeout
+            while inflight.count and time.monotonic() < deadline:
+                time.sleep(0.05)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    def reap(self):
+        """Collect exited workers, and replace those of the current app that died."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            self.retiring.discard(pid)
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    print(f"Worker {pid} exited with status {status}, starting a new one")
+                    self.spawn()
+
+    def replace_workers(self, rebuild):
+        """Fork new workers, from a new app if `rebuild`, and retire the old ones."""
+        old_app = self.app
+        if rebuild:
+            gc.unfreeze()  # objects of the old app can be collected once its workers are gone
+            start = time.time()
+            try:
+                self.app = self.build()
+            except Exception as e:
+                print(f"Failed to reload, the old workers keep serving: {e!r}")
+                return
+            if old_app.watcher is not None:
+                old_app.watcher.stop()
+            print(time.time() - start, "time spent to reload the mesh")
+        old_workers, self.workers = self.workers, set()
+        for _ in range(self.n_workers):
+            self.spawn()
+        for pid in old_workers:
+            self._signal(pid, signal.SIGTERM)
+        self.retiring |= old_workers
+
+    def _signal(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reload_requested = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        self.app = self.build()
+        self.socket = socket.create_server((self.config.host, self.config.port), backlog=1024)
+        # workers that lose the race for a connection go back to waiting instead of blocking in accept
+        self.socket.setblocking(False)
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_signal)
+        for _ in range(self.n_workers):
+            self.spawn()
+        print(
+            f"Serving on http://{self.config.host}:{self.config.port} with {self.n_workers} workers "
+            f"(master pid {os.getpid()}, kill -HUP it to reload)"
+        )
+        try:
+            while not self.stopping:
+                self.reap()
+                if self.reload_requested or self.refork_requested:
+                    rebuild = self.reload_requested
+                    self.reload_requested = self.refork_requested = False
+                    self.replace_workers(rebuild)
+                time.sleep(0.2)
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.stopping = True
+        workers = self.workers | self.retiring
+        for pid in workers:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while workers and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                workers.discard(pid)
+            else:
+                time.sleep(0.05)
+        for pid in workers:
+            self._signal(pid, signal.SIGKILL)
+        if self.socket is not None:
+            self.socket.close()
@@ -0,0 +1,110 @@
+import json
+import mmap
+import os
+import struct
+from hashlib import sha256
+
+import numpy as np
+
+MAGIC = b"ESPMESH\0"
+VERSION = 1
+ALIGN = 4096  # arrays start on page boundaries, so that each maps to its own pages
+_PREFIX = struct.Struct("<8sII")  # magic, version, length of the JSON header
+
+
+def docs_digest(docs):
+    """
+    sha256 of (doc id, content hash, path, title) tuples, to check that a snapshot matches the
+    notes. Ids come from the content, so the path and title catch notes moved without edits.
+    """
+    digest = sha256()
+    for doc in sorted(tuple(map(str, doc)) for doc in docs):
+        digest.update((json.dumps(doc) + "\n").encode())
+    return digest.hexdigest()
+
+
+def _aligned(offset):
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write_snapshot(path, arrays, strings, meta):
+    """
+    Write numpy `arrays` and lists of `strings` by name, with a JSON-serializable `meta`, to a
+    snapshot file that `Snapshot` maps back without parsing it.
+
+    The file starts with MAGIC, the format VERSION and a JSON header giving the dtype, shape and
+    offset of each array, then holds the raw arrays. Each list of strings is stored as one
+    uint8 array of its NUL-separated UTF-8 texts. The file is written next to `path` and
+    atomically renamed over it: mappings of the previous snapshot keep reading the old file.
+    """
+    blobs = {}
+    for name, texts in strings.items():
+        if any("\0" in text for text in texts):
+            raise ValueError(f"The strings of {name} can't contain NUL characters.")
+        blobs[name] = np.frombuffer("\0".join(texts).encode(), dtype=np.uint8)
+    items = [(name, np.ascontiguousarray(array)) for name, array in arrays.items()]
+    items += [("strings:" + name, blob) for name, blob in blobs.items()]
+    layout, offset = {}, 0
+    for name, array in items:
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(
+        {
+            "meta": meta,
+            "arrays": layout,
+            "strings": {name: len(texts) for name, texts in strings.items()},
+        }
+    ).encode()
+    start = _aligned(_PREFIX.size + len(header))
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for name, array in items:
+            f.seek(start + layout[name][2])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot written by `write_snapshot`.
+
+    The file is memory-mapped copy-on-write: arrays are used in place, so opening a snapshot
+    costs the same whatever its size, pages are read from disk when they are first touched,
+    and processes mapping the same snapshot share them until one writes to an array, which
+    then gets its own copy of the pages it wrote. Raises ValueError if the file isn't a
+    snapshot of this version.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(self.buffer) < _PREFIX.size:
+            raise ValueError(f"{path} is not an Espial snapshot.")
+        magic, version, header_size = _PREFIX.unpack_from(self.buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an Espial snapshot.")
+        if version != VERSION:
+            raise ValueError(f"{path} is a snapshot of version {version}, not {VERSION}.")
+        header = json.loads(self.buffer[_PREFIX.size : _PREFIX.size + header_size])
+        self.meta = header["meta"]
+        self.layout = header["arrays"]
+        self.counts = header["strings"]
+        self.start = _aligned(_PREFIX.size + header_size)
+
+    def __contains__(self, name):
+        return name in self.layout
+
+    def array(self, name):
+        dtype, shape, offset = self.layout[name]
+        count = int(np.prod(shape))
+        array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=self.start + offset)
+        return array.reshape(shape)
+
+    def strings(self, name):
+        if not self.counts[name]:
+            return []
+        return self.array("strings:" + name).tobytes().decode().split("\0")
@@ -0,0 +1,78 @@
+import threading
+import time
+import traceback
+
+from espial.metrics import metrics
+
+
+class Startup:
+    """
+    Progress of the stages `create_app` runs in the background before every view is available,
+    as reported by the /status endpoint.
+    """
+
+    def __init__(self, stages):
+        self.stages = {
+            name: {"state": "pending", "seconds": None, "done": 0, "total": None}
+            for name in stages
+        }
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = threading.Event()  # set once every stage ran or one of them failed
+
+    def run(self, name, fn, *args):
+        """Run a stage, recording its state and duration. Returns its result, re-raises its errors."""
+        stage = self.stages[name]
+        with self.lock:
+            stage["state"] = "running"
+        try:
+            with metrics.span(name) as span:
+                result = fn(*args)
+        except Exception as e:
+            with self.lock:
+                stage["state"] = "failed"
+                stage["error"] = repr(e)
+            traceback.print_exc()
+            raise
+        with self.lock:
+            stage["state"] = "done"
+            stage["seconds"] = round(span.seconds, 3)
+        return result
+
+    def skip(self, name):
+        with self.lock:
+            self.stages[name]["state"] = "skipped"
+
+    def progress(self, name):
+        """Callback for `fn(done, total)` progress updates of a stage."""
+
+        def update(done, total):
+            with self.lock:
+                self.stages[name]["done"] = done
+                self.stages[name]["total"] = total
+
+        return update
+
+    def ready(self, name):
+        """Whether a stage and the ones before it have finished."""
+        with self.lock:
+            for stage_name, stage in self.stages.items():
+                if stage["state"] not in ("done", "skipped"):
+                    return False
+                if stage_name == name:
+                    return True
+        return True
+
+    def wait(self, timeout=None):
+        """Block until startup finished, returns whether it did."""
+        return self.finished.wait(timeout)
+
+    def status(self):
+        with self.lock:
+            stages = [dict(stage, name=name) for name, stage in self.stages.items()]
+        return {
+            "ready": all(s["state"] in ("done", "skipped") for s in stages),
+            "failed": any(s["state"] == "failed" for s in stages),
+            "uptime": round(time.time() - self.started, 3),
+            "stages": stages,  # in the order they run
+        }
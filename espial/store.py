@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from spacy.tokens import Doc, DocBin
+
+
+class AnnotationStore:
+    """
+    Per-document store of parsed spaCy docs, keyed by the sha256 hash of their content.
+
+    Docs are appended to a log file and an index maps each hash to its offset in the log,
+    so saving a new doc never rewrites the others and loading a doc only reads its own bytes.
+    Entries of docs that are no longer part of the knowledge base become stale and are dropped
+    when the log is compacted into a log of the next generation: the index names its log, so
+    the compacted log only replaces the old one once the index pointing into it is saved. The
+    old log is kept for processes still reading it, until the next compaction removes it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log_name = "docs.log"  # log the index points into
+        self.index_path = path / "index.json"
+        self.index = {}  # hash -> (offset, length) in the log
+        self.live = set()  # hashes of the docs in the knowledge base at the last flush
+        self.path.mkdir(exist_ok=True)
+        if self.index_path.exists():
+            saved = json.load(self.index_path.open("r"))
+            self.index = {hash: tuple(entry) for hash, entry in saved["index"].items()}
+            self.live = set(saved["live"])
+            self.log_name = saved.get("log", self.log_name)
+        self._log_size = self.log_path.stat().st_size if self.log_path.exists() else 0
+
+    @property
+    def log_path(self):
+        return self.path / self.log_name
+
+    def __contains__(self, hash):
+        return hash in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, hash, vocab):
+        with self.log_path.open("rb") as f:
+            return self._read(f, hash, vocab)
+
+    def get_many(self, hashes, vocab):
+        """Yield (hash, doc) for the given hashes, reading the log in offset order."""
+        if not hashes:
+            return
+        with self.log_path.open("rb") as f:
+            for hash in sorted(hashes, key=lambda h: self.index[h][0]):
+                yield hash, self._read(f, hash, vocab)
+
+    def _read(self, f, hash, vocab):
+        offset, length = self.index[hash]
+        f.seek(offset)
+        return Doc(vocab).from_bytes(zlib.decompress(f.read(length)))
+
+    def put_many(self, docs):
+        """Append docs to the log. They are only visible to later runs after `flush`."""
+        with self.log_path.open("ab") as f:
+            for doc in docs:
+                data = zlib.compress(doc.to_bytes(exclude=["tensor"]))
+                f.write(data)
+                self.index[doc._.hash] = (self._log_size, len(data))
+                self._log_size += len(data)
+
+    def put(self, doc):
+        self.put_many([doc])
+
+    def flush(self, live=None):
+        """Atomically save the index, recording the hashes of the docs currently in the KB."""
+        if live is not None:
+            self.live = set(live)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(
+                {
+                    "index": {hash: list(entry) for hash, entry in self.index.items()},
+                    "live": sorted(self.live),
+                    "log": self.log_name,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def stale_ratio(self):
+        """Fraction of the log taken by docs that are no longer in the KB."""
+        if not self._log_size:
+            return 0
+        live_size = sum(self.index[hash][1] for hash in self.live if hash in self.index)
+        return 1 - live_size / self._log_size
+
+    def compact(self):
+        """
+        Rewrite the docs in the KB to a log of the next generation, which the saved index then
+        points to. Until it is saved, the old index and log are left as they are. Logs of
+        older generations, or left by a compaction that didn't finish, are removed.
+        """
+        old_path = self.log_path
+        for log in self.path.glob("docs*.log"):
+            if log != old_path:
+                log.unlink()
+        generation = 1 if self.log_name == "docs.log" else int(self.log_name.split(".")[1]) + 1
+        log_name = f"docs.{generation}.log"
+        index = {}
+        offset = 0
+        with old_path.open("rb") as src, (self.path / log_name).open("wb") as dst:
+            for hash in sorted(self.live & self.index.keys(), key=lambda h: self.index[h][0]):
+                src.seek(self.index[hash][0])
+                data = src.read(self.index[hash][1])
+                dst.write(data)
+                index[hash] = (offset, len(data))
+                offset += len(data)
+        self.index = index
+        self.log_name = log_name
+        self._log_size = offset
+        self.flush()
+
+    def migrate(self, doc_bin_path, vocab):
+        """Import the docs of a single-file DocBin (the format used by older versions) and remove it."""
+        with doc_bin_path.open("rb") as f:
+            doc_bin = DocBin(store_user_data=True).from_bytes(f.read())
+        docs = [doc for doc in doc_bin.get_docs(vocab) if doc._.hash not in self.index]
+        self.put_many(docs)
+        self.flush(self.live | {doc._.hash for doc in docs})
+        doc_bin_path.unlink()
+
+
+class DocRecord:
+    """
+    Metadata of a parsed doc, used in place of the doc when docs are loaded lazily.
+    Its attributes are also available under `._`, like the extensions of a spaCy Doc.
+    """
+
+    __slots__ = ("id", "title", "path", "hash", "doc_type")
+
+    def __init__(self, id, title, path, hash, doc_type="note"):
+        self.id = id
+        self.title = title
+        self.path = path
+        self.hash = hash
+        self.doc_type = doc_type
+
+    @property
+    def _(self):
+        return self
+
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(doc._.id, doc._.title, doc._.path, doc._.hash, doc._.doc_type)
+
+
+class DocCache(MutableMapping):
+    """
+    Docs of the mesh by id.
+
+    By default every parsed doc is kept in memory. With `size` set, only a DocRecord is kept
+    for each doc and `doc(id)` reads full docs from the annotation store, keeping the `size`
+    most recently used ones.
+    """
+
+    def __init__(self, store, vocab, size=None):
+        self.store = store
+        self.vocab = vocab
+        self.size = size
+        self.records = {}  # id -> doc, or DocRecord if docs are loaded lazily
+        self.docs = OrderedDict()  # id -> recently used docs, if docs are loaded lazily
+        self.lock = threading.Lock()
+
+    def __getitem__(self, id):
+        return self.records[id]
+
+    def __setitem__(self, id, doc):
+        if self.size is None:
+            self.records[id] = doc
+            return
+        self.records[id] = DocRecord.from_doc(doc)
+        self._cache(id, doc)
+
+    def __delitem__(self, id):
+        del self.records[id]
+        with self.lock:
+            self.docs.pop(id, None)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add_record(self, id, title, path, hash, doc_type="note"):
+        """Add a doc of the store by its metadata, without reading it. Docs must be loaded lazily."""
+        if self.size is None:
+            raise ValueError("Records can only be added when docs are loaded lazily.")
+        self.records[id] = DocRecord(id, title, path, hash, doc_type)
+
+    def _cache(self, id, doc):
+        with self.lock:
+            self.docs[id] = doc
+            self.docs.move_to_end(id)
+            while len(self.docs) > self.size:
+                self.docs.popitem(last=False)
+
+    def doc(self, id):
+        """Full parsed doc, read from the store if it isn't in memory."""
+        if self.size is None:
+            return self.records[id]
+        with self.lock:
+            if id in self.docs:
+                self.docs.move_to_end(id)
+                return self.docs[id]
+        record = self.records[id]
+        doc = self.store.get(record.hash, self.vocab)
+        doc._.id, doc._.title, doc._.path, doc._.hash, doc._.doc_type = (
+            record.id,
+            record.title,
+            record.path,
+            record.hash,
+            record.doc_type,
+        )
+        self._cache(id, doc)
+        return doc
@@ -0,0 +1,86 @@
+import difflib
+import re
+from pathlib import Path
+
+from espial.jobs import Job, write_atomic
+
+
+def tag_edits(mesh, concepts):
+    """
+    The tags to create for some concepts, grouped by file:
+    path -> {lowercased text that mentions a concept: concept}.
+    External docs aren't files and are skipped.
+    """
+    edits = {}
+    for concept in concepts:
+        for doc, data in mesh.concept_edges(concept):
+            info = mesh.doc_info(doc)
+            if info["doc_type"] == "external":
+                continue
+            texts = edits.setdefault(info["path"], {})
+            for orig in data.get("orig", []):
+                texts.setdefault(orig.lower(), concept)
+    return edits
+
+
+def tag_text(contents, texts):
+    """
+    Replace the occurences of each text between spaces or lines by #concept, in a single
+    pass. Longer texts are matched first, so "New York" becomes #new york and not #new #york.
+    """
+    if not texts:
+        return contents
+    alternatives = "|".join(re.escape(t) for t in sorted(texts, key=len, reverse=True))
+    # the separators are looked around rather than matched, so adjacent occurences are all found
+    tag_re = re.compile(rf"(?<![^\n ])({alternatives})(?![^\n ])", re.IGNORECASE)
+
+    def tag(match):
+        concept = texts.get(match.group(1).lower())
+        if concept is None:
+            return match.group(0)
+        return f"#{concept}"
+
+    return tag_re.sub(tag, contents)
+
+
+class TagJob(Job):
+    """
+    Rewrites the files of `tag_edits`: each file is read once, gets all its tags in one pass
+    and is replaced atomically. With `dry_run`, files are left as they are and a unified diff
+    of the changes is collected instead.
+    """
+
+    name = "tags"
+
+    def __init__(self, edits, dry_run=False, max_workers=8):
+        super().__init__(edits, max_workers)
+        self.dry_run = dry_run
+        self.diffs = {}  # path -> unified diff, in dry runs
+
+    @property
+    def edits(self):
+        return self.items
+
+    def process(self, path, texts):
+        path = Path(path)
+        contents = path.open("r").read()
+        tagged = tag_text(contents, texts)
+        if tagged != contents:
+            if self.dry_run:
+                diff = "".join(
+                    difflib.unified_diff(
+                        contents.splitlines(True), tagged.splitlines(True), str(path), str(path)
+                    )
+                )
+                with self.lock:
+                    self.diffs[str(path)] = diff
+            else:
+                write_atomic(path, tagged)
+        return tagged != contents
+
+    def diff(self):
+        with self.lock:
+            return "".join(self.diffs[path] for path in sorted(self.diffs))
+
+    def status(self):
+        return dict(super().status(), dry_run=self.dry_run)
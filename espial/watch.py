@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+
+from espial.analysis import process_markdown
+from espial.load import read_item
+from espial.metrics import metrics
+
+try:
+    import inotify_simple
+except ImportError:  # optional, changes are found by polling without it
+    inotify_simple = None
+
+
+class ReadWriteLock:
+    """
+    Lock that any number of readers, or a single writer, can hold at once.
+    Waiting writers go before new readers so that updates aren't starved by requests.
+
+    A process forked while threads hold or wait for the lock has none of these threads, so
+    the lock starts over unlocked in the child, see espial/serve.py.
+    """
+
+    def __init__(self):
+        self._reset()
+        reset = weakref.WeakMethod(self._reset)
+        os.register_at_fork(after_in_child=lambda: reset() is not None and reset()())
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class Watcher(threading.Thread):
+    """
+    Watches the markdown files of the knowledge base and calls `on_change` with the set of
+    paths that were created, modified or deleted.
+
+    Uses inotify if `inotify_simple` is installed, otherwise polls the files' stat every
+    `poll_interval` seconds. Changes are batched until none happened for `debounce` seconds,
+    so that saving a note several times in a row only triggers one update.
+    """
+
+    def __init__(self, config, on_change):
+        super().__init__(daemon=True)
+        self.data_dir = Path(config.data_dir)
+        self.ignore = [self.data_dir / p for p in config.IGNORE]
+        self.debounce = config.WATCH["debounce"]
+        self.poll_interval = config.WATCH["poll_interval"]
+        self.on_change = on_change
+        self.stopped = threading.Event()
+
+    def watched(self, path):
+        relative = path.relative_to(self.data_dir)
+        return not any(
+            part.startswith(".") for part in relative.parts
+        ) and not any(path.parent == p for p in self.ignore)
+
+    def run(self):
+        changes = self._inotify_changes() if inotify_simple else self._polled_changes()
+        pending = set()
+        for paths in changes:  # yields the changed paths, or an empty set after a quiet period
+            pending.update(
+                p
+                for p in paths
+                if (p.suffix == ".md" or not p.exists()) and self.watched(p)
+            )
+            if pending and not paths:
+                batch, pending = pending, set()
+                try:
+                    self.on_change(batch)
+                except Exception as e:  # keep watching, the next change may fix it
+                    print(f"Failed to update the mesh with {len(batch)} changed docs: {e!r}")
+            if self.stopped.is_set():
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+    def _inotify_changes(self):
+        flags = inotify_simple.flags
+        mask = (
+            flags.CLOSE_WRITE
+            | flags.CREATE
+            | flags.DELETE
+            | flags.MOVED_FROM
+            | flags.MOVED_TO
+        )
+        inotify = inotify_simple.INotify()
+        dirs = {}
+
+        def add_watch(path):
+            if path == self.data_dir or self.watched(path):
+                dirs[inotify.add_watch(path, mask)] = path
+
+        add_watch(self.data_dir)
+        for path in self.data_dir.rglob("*"):
+            if path.is_dir():
+                add_watch(path)
+        while not self.stopped.is_set():
+            paths = set()
+            for event in inotify.read(timeout=int(self.debounce * 1000)):
+                if event.wd not in dirs:
+                    continue
+                path = dirs[event.wd] / event.name
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.CREATE | flags.MOVED_TO):
+                        add_watch(path)
+                        paths.update(path.rglob("*.md"))
+                    else:  # the docs of a deleted directory get no events of their own
+                        paths.add(path)
+                else:
+                    paths.add(path)
+            yield paths
+
+    def _stat(self):
+        stats = {}
+        for path in self.data_dir.rglob("*.md"):
+            if self.watched(path):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                stats[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return stats
+
+    def _polled_changes(self):
+        stats = self._stat()
+        while not self.stopped.wait(self.poll_interval):
+            new_stats = self._stat()
+            yield {
+                path
+                for path in stats.keys() | new_stats.keys()
+                if stats.get(path) != new_stats.get(path)
+            }
+            stats = new_stats
+            if self.debounce > self.poll_interval:  # give the quiet period time to pass
+                self.stopped.wait(self.debounce - self.poll_interval)
+
+
+class MeshUpdater:
+    """
+    Folds changed files into a live mesh: changed docs are read and parsed without holding
+    `lock`, which is only taken for writing to swap them into the mesh and update the concepts
+    they mention. When every concept must be filtered again (see `update_concepts`), that is
+    done in a copy of the mesh without the lock, then swapped in. `on_update` is then called
+    while holding it for reading.
+    """
+
+    def __init__(self, mesh, nlp, config, lock, on_update=None):
+        self.mesh = mesh
+        self.nlp = nlp
+        self.config = config
+        self.lock = lock
+        self.on_update = on_update
+
+    def __call__(self, paths):
+        mesh = self.mesh
+        start = time.time()
+        with self.lock.read():
+            doc_ids = {
+                mesh.doc_paths[row]: (id, mesh.doc_hashes[row])
+                for id, row in mesh.doc_vectors.rows.items()
+            }
+        removed, unseen = [], []
+        for path in paths:
+            if path.suffix != ".md":  # a deleted directory
+                prefix = str(path) + os.sep
+                removed.extend(id for p, (id, _) in doc_ids.items() if p.startswith(prefix))
+                continue
+            old = doc_ids.get(str(path))
+            try:
+                item = read_item(path, self.config)
+            except FileNotFoundError:
+                if old is not None:
+                    removed.append(old[0])
+                continue
+            if old is not None and old == (item["id"], item["hash"]):
+                continue
+            if old is not None:
+                removed.append(old[0])
+            content = process_markdown(item["content"])
+            if len(content) < 1000000:
+                unseen.append((content, item))
+        if not removed and not unseen:
+            return
+
+        docs = []
+        for doc, item in self.nlp.pipe(
+            unseen,
+            as_tuples=True,
+            disable=["textcat"],
+            batch_size=self.config.ANALYSIS["batch_size"],
+        ):
+            doc._.id = item["id"]
+            doc._.title = item["title"]
+            doc._.path = item["path"]
+            doc._.hash = item["hash"]
+            docs.append(doc)
+        store = getattr(mesh.doc_cache, "store", None)
+        if store is not None:
+            store.put_many(docs)
+
+        max_idf_drift = self.config.ANALYSIS["incremental"]["max_idf_drift"]
+        with self.lock.write():
+            for id in removed:
+                if mesh.has_doc(id):
+                    mesh.remove_doc(id)
+            for doc in docs:
+                if mesh.has_doc(doc._.id):
+                    mesh.remove_doc(doc._.id)
+                mesh.process_document(doc)
+            full_update = mesh.needs_full_update(max_idf_drift)
+            if not full_update:
+                n_updated = mesh.update_concepts(max_idf_drift)
+        if full_update:
+            # only this thread changes the mesh, so every concept can be filtered again in a copy
+            # while requests keep reading the mesh, which only needs the lock to take the results
+            filtered = mesh.refiltered()
+            with self.lock.write():
+                mesh.adopt_filtering(filtered)
+            n_updated = len(mesh.concept_names)
+        metrics.record_stage("watch_update", time.time() - start)
+        print(
+            time.time() - start,
+            f"time spent to fold {len(docs)} changed and {len(removed)} deleted docs, "
+            f"{n_updated} concepts updated",
+        )
+        with self.lock.read():
+            if store is not None:
+                store.flush({doc._.hash for doc in mesh.doc_cache.values()})
+            if self.on_update is not None:
+                self.on_update()
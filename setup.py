@@ -18,8 +18,9 @@ setup(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License"
     ],
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     install_requires=install_requires,
+    extras_require={"watch": ["inotify_simple"]},
     include_package_data=True,
     entry_points={"console_scripts": ["espial=espial.cli:espial"]}
 )